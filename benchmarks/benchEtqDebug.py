@@ -0,0 +1,381 @@
+"""
+Offline benchmarks for EtqDebug's own overhead, run against the fakes in relianceFakes.py.
+
+    python benchmarks/benchEtqDebug.py                      # all cases, JSON to stdout
+    python benchmarks/benchEtqDebug.py --case log_ --min-time 1
+    python benchmarks/benchEtqDebug.py --output base.json
+    python benchmarks/benchEtqDebug.py --compare base.json --tolerance 0.2
+
+Run it with the interpreter the profile targets (Jython 2.7 or CPython 2.7).
+Each result reports calls/sec (best of --repeat runs) and allocations per call:
+bytes/blocks from tracemalloc when the interpreter has it, otherwise the net
+number of GC-tracked objects left behind per call (a leak/retention signal).
+--compare exits with status 1 if any case is slower than the baseline by more
+than --tolerance.
+"""
+import argparse
+import gc
+import inspect
+import json
+import os
+import platform
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import relianceFakes
+
+timer = time.time if sys.platform.startswith('java') else getattr(time, 'perf_counter', time.time)
+
+
+def measureSpeed(func, minTime, repeat):
+    """Calibrate a loop count that runs for at least minTime, then return (loops, best seconds per loop)."""
+    func()
+    loops = 1
+    while True:
+        start = timer()
+        for _ in range(loops):
+            func()
+        elapsed = timer() - start
+        if elapsed >= minTime or loops >= 1 << 24:
+            break
+        loops = loops * 10 if elapsed < minTime / 10.0 else int(loops * minTime / max(elapsed, 1e-9)) + 1
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = timer()
+        for _ in range(loops):
+            func()
+        best = min(best, timer() - start)
+    return loops, best / loops
+
+
+def measureAllocations(func, loops):
+    """Allocations per call over `loops` calls (see the module docstring for the two methods)."""
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    gc.collect()
+    if tracemalloc is not None:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        for _ in range(loops):
+            func()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        stats = after.compare_to(before, 'filename')
+        return {
+            'method': 'tracemalloc',
+            'bytesPerCall': sum(stat.size_diff for stat in stats) / float(loops),
+            'blocksPerCall': sum(stat.count_diff for stat in stats) / float(loops),
+        }
+
+    if not hasattr(gc, 'get_count'):
+        return {'method': None}
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        before = gc.get_count()[0]
+        for _ in range(loops):
+            func()
+        after = gc.get_count()[0]
+    finally:
+        if enabled:
+            gc.enable()
+    return {'method': 'gc', 'objectsPerCall': (after - before) / float(loops)}
+
+
+class Benchmarks(object):
+    """
+    The benchmark cases. Each case_* method sets up its instance and returns
+    (func, extra) where func() is one call to measure and extra is merged into the result,
+    or None when the etqDebug.py under test (e.g. an older one given with --path) lacks the feature.
+    """
+    def __init__(self, path=relianceFakes.ETQ_DEBUG_PATH):
+        self.path = path
+        self.namespace = relianceFakes.loadEtqDebug(path)
+        self.EtqDebug = self.namespace['EtqDebug']
+        self.document = self.namespace['thisDocument']
+
+    def cases(self):
+        return sorted(name[len('case_'):] for name in dir(self) if name.startswith('case_'))
+
+    def debug(self, **kwargs):
+        kwargs.setdefault('document', self.document)
+        return self.EtqDebug(**kwargs)
+
+    def accepts(self, method, *names):
+        """True if EtqDebug has `method` and it takes every argument in `names`."""
+        func = getattr(self.EtqDebug, method, None)
+        if func is None:
+            return False
+        getargspec = getattr(inspect, 'getfullargspec', None) or inspect.getargspec
+        args = getargspec(func).args
+        return all(name in args for name in names)
+
+    # ----- construction -----
+
+    def case_construct(self):
+        return lambda: self.EtqDebug(), {}
+
+    def case_construct_forDocument(self):
+        if not self.accepts('forDocument'):
+            return None
+        return lambda: self.EtqDebug.forDocument(), {}
+
+    # ----- log() -----
+
+    def case_log_disabled(self):
+        debug = self.debug(minLevel='error')
+        return lambda: debug.log('filtered message'), {}
+
+    def case_log_disabled_args(self):
+        if not self.accepts('log', 'args'):
+            return None
+        debug = self.debug(minLevel='error')
+        return lambda: debug.log('row %s of %s', args=(1, 2)), {}
+
+    def case_log_enabled_caller(self):
+        debug = self.debug(minLevel='debug')
+        return lambda: debug.log('enabled message', 'Label'), {}
+
+    def case_log_enabled_noCaller(self):
+        debug = self.debug(minLevel='debug')
+        return lambda: debug.log('enabled message', 'Label', showCaller=False), {}
+
+    def case_log_disabled_metrics(self):
+        if 'EtqDebugMetrics' not in self.namespace:
+            return None
+        debug = self.debug(minLevel='error', metrics=True)
+        return lambda: debug.log('filtered message'), {}
+
+    def case_log_enabled_metrics(self):
+        if 'EtqDebugMetrics' not in self.namespace:
+            return None
+        debug = self.debug(minLevel='debug', metrics=True)
+        return lambda: debug.log('enabled message', 'Label'), {}
+
+    def _substitution(self, placeholders, cached):
+        if cached and not self.accepts('clearFieldCache'):
+            return None
+        # Without a TTL the field cache only lives for one log() call, so the cached case opts in
+        debug = self.debug(minLevel='debug', fieldCacheTtl=3600) if cached else self.debug(minLevel='debug')
+        names = ['FIELD_{}'.format(index) for index in range(placeholders - 1)] + ['LINK_0']
+        template = u' '.join(u'{%s}' % name for name in names)
+        extra = {'placeholders': placeholders, 'fieldCache': cached}
+        if cached or not hasattr(debug, 'clearFieldCache'):
+            func = lambda: debug._getFieldsInString(template)
+            if not cached:
+                # No way to reset the cache: after the first call this times cached lookups
+                extra['fallback'] = 'cachedFields'
+        else:
+            def func():
+                debug.clearFieldCache()
+                return debug._getFieldsInString(template)
+        return func, extra
+
+    def case_substitute_k1(self):
+        return self._substitution(1, cached=False)
+
+    def case_substitute_k10(self):
+        return self._substitution(10, cached=False)
+
+    def case_substitute_k10_cached(self):
+        return self._substitution(10, cached=True)
+
+    def case_substitute_k20(self):
+        return self._substitution(20, cached=False)
+
+    def case_log_multiple_dict100(self):
+        if not self.accepts('log', 'maxDepth'):
+            return None
+        debug = self.debug(minLevel='debug')
+        payload = dict(('key{}'.format(index), [index, u'value {}'.format(index), {'nested': index}]) for index in range(100))
+        return lambda: debug.log(payload, 'Payload', multiple=True, maxDepth=2), {'items': 100}
+
+    def case_log_multiple_list1000(self):
+        debug = self.debug(minLevel='debug')
+        payload = [u'row {}'.format(index) for index in range(1000)]
+        return lambda: debug.log(payload, 'Rows', multiple=True), {'items': 1000}
+
+    # ----- email() -----
+
+    def case_email_pool(self):
+        if 'EtqDebugMailWorkerPool' not in self.namespace:
+            return None
+        # Stub mailer: exercises the queue, workers and counters without PublicMailSender
+        pool = self.namespace['EtqDebugMailWorkerPool'](workers=2, mailer=lambda mailObj, sendFailureNotification: None)
+        debug = self.debug(minLevel='debug', mailPool=pool)
+
+        def func():
+            debug.email('pooled message', toEmails=['dev@example.com'], level='error')
+            pool.join()
+        return func, {}
+
+    # ----- executeQuery() -----
+
+    def _query(self, rows, **kwargs):
+        relianceFakes.installDaoFactory(rows)
+        debug = self.debug(minLevel='debug')
+        return lambda: debug.executeQuery('SELECT * FROM BENCH', **kwargs), {'rows': rows}
+
+    def case_executeQuery_1k(self):
+        return self._query(1000, maxRows=1000)
+
+    def _streamQuery(self, rows):
+        if self.accepts('executeQuery', 'stream'):
+            return self._query(rows, stream=True, maxRows=None)
+        # Before streaming, dumping every row meant maxRows=rows (maxRows=None would fetch nothing)
+        func, extra = self._query(rows, maxRows=rows)
+        extra['fallback'] = 'maxRows'
+        return func, extra
+
+    def case_executeQuery_1k_stream(self):
+        return self._streamQuery(1000)
+
+    def case_executeQuery_100k_stream(self):
+        return self._streamQuery(100000)
+
+    def case_executeQuery_1k_return(self):
+        return self._query(1000, output='return', maxRows=1000)
+
+    # ----- databaseTablesInfo() -----
+
+    def case_databaseTablesInfo_5(self):
+        if not self.accepts('databaseTablesInfo', 'useCache'):
+            return None
+        tableNames = ['BENCH_{}'.format(index) for index in range(5)]
+        self.namespace['thisApplication'].dataSourceRows = relianceFakes.makeTableInfoRows(tableNames)
+        debug = self.debug(minLevel='debug')
+        return lambda: debug.databaseTablesInfo(tableNames, useCache=False, logResults=False), {'tables': len(tableNames)}
+
+    # ----- runBatch() (8 queries, 20 ms DAO latency each) -----
+
+    def _batch(self):
+        relianceFakes.installDaoFactory(50, latency=0.02)
+        return ['SELECT * FROM BENCH_{}'.format(index) for index in range(8)]
+
+    def case_batch_sequential(self):
+        if not self.accepts('executeQueries'):
+            return None
+        debug = self.debug(minLevel='debug')
+        queries = self._batch()
+        return lambda: debug.executeQueries(queries, maxRows=50, queryStats=False), {'queries': len(queries)}
+
+    def case_batch_parallel(self):
+        if not self.accepts('runBatch'):
+            return None
+        debug = self.debug(minLevel='debug')
+        queries = self._batch()
+        return lambda: debug.runBatch(queries, workers=4, maxRows=50), {'queries': len(queries), 'workers': 4}
+
+    # ----- profileCode() -----
+
+    def _profiled(self):
+        return sum(index * index for index in range(200))
+
+    def case_profileCode_baseline(self):
+        return self._profiled, {}
+
+    # No profiler options: older profileCode() versions would pass them to the profiled function
+
+    def case_profileCode_profile(self):
+        debug = self.debug(minLevel='debug')
+        return lambda: debug.profileCode(self._profiled), {}
+
+    def case_profileCode_disabled(self):
+        debug = self.debug(minLevel='error')
+        return lambda: debug.profileCode(self._profiled), {}
+
+
+def run(benchmarks, names, minTime, repeat, allocationLoops):
+    results = []
+    for name in names:
+        case = getattr(benchmarks, 'case_' + name)()
+        if case is None:
+            continue
+        func, extra = case
+        loops, seconds = measureSpeed(func, minTime, repeat)
+        # Rutilities.debug() traffic of a single call
+        relianceFakes.FakeRutilities.reset()
+        func()
+        result = {
+            'name': name,
+            'loops': loops,
+            'usPerCall': seconds * 1e6,
+            'callsPerSec': 1.0 / seconds if seconds else None,
+            'debugWritesPerCall': relianceFakes.FakeRutilities.calls,
+            'debugCharsPerCall': relianceFakes.FakeRutilities.chars,
+        }
+        result['allocations'] = measureAllocations(func, max(1, min(allocationLoops, loops)))
+        if 'rows' in extra and seconds:
+            result['rowsPerSec'] = extra['rows'] / seconds
+        result.update(extra)
+        results.append(result)
+    return results
+
+
+def compare(results, baselinePath, tolerance):
+    """Return the cases whose calls/sec dropped by more than tolerance against the baseline file."""
+    with open(baselinePath) as source:
+        baseline = dict((result['name'], result) for result in json.load(source)['results'])
+    regressions = []
+    for result in results:
+        previous = baseline.get(result['name'])
+        if not previous or not previous.get('callsPerSec') or not result['callsPerSec']:
+            continue
+        ratio = result['callsPerSec'] / previous['callsPerSec']
+        result['baselineRatio'] = ratio
+        if ratio < 1 - tolerance:
+            regressions.append(result['name'])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark EtqDebug overhead against in-process Reliance fakes.')
+    parser.add_argument('--case', action='append', default=[], help='run cases whose name starts with this prefix (repeatable)')
+    parser.add_argument('--list', action='store_true', help='list case names and exit')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per timed run')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per case (best is reported)')
+    parser.add_argument('--alloc-loops', type=int, default=1000, help='calls measured for allocations')
+    parser.add_argument('--path', default=relianceFakes.ETQ_DEBUG_PATH, help='etqDebug.py to benchmark')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    parser.add_argument('--compare', help='baseline JSON from a previous --output run')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed calls/sec drop against --compare')
+    options = parser.parse_args(argv)
+
+    benchmarks = Benchmarks(options.path)
+    names = [name for name in benchmarks.cases() if not options.case or any(name.startswith(prefix) for prefix in options.case)]
+    if options.list:
+        print('\n'.join(names))
+        return 0
+
+    results = run(benchmarks, names, options.min_time, options.repeat, options.alloc_loops)
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_implementation() + ' ' + platform.python_version(),
+            'platform': platform.platform(),
+            'path': os.path.abspath(options.path),
+            'minTime': options.min_time,
+            'repeat': options.repeat,
+        },
+        'results': results,
+    }
+    regressions = compare(results, options.compare, options.tolerance) if options.compare else []
+    if options.compare:
+        report['regressions'] = regressions
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as target:
+            target.write(text + '\n')
+    else:
+        print(text)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
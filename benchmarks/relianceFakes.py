@@ -0,0 +1,355 @@
+"""
+In-process stand-ins for the objects EtQ Reliance injects into an EtQScript:
+engineConfig, thisUser, thisDocument, thisApplication, Rutilities, PublicMail,
+PublicMailSender, PublicECCProfileManager, PublicAttachment and
+com.etq.reliance.dao.DaoFactory.
+
+They implement only the calls etqDebug.py makes, with no I/O, so benchmarks
+measure EtqDebug itself. loadEtqDebug() exec's etqDebug.py into a namespace
+holding the fakes, the same way a script profile is exec'd on the server.
+"""
+import os
+import sys
+import time
+import types
+
+ETQ_DEBUG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'etqDebug.py')
+
+
+class FakeRutilities(object):
+    """Rutilities.debug() that only counts calls and characters."""
+    calls = 0
+    chars = 0
+
+    @classmethod
+    def debug(cls, text):
+        cls.calls += 1
+        cls.chars += len(text)
+
+    @classmethod
+    def reset(cls):
+        cls.calls = 0
+        cls.chars = 0
+
+
+class FakeEngineConfig(object):
+    def __init__(self, environmentName='production'):
+        self.environmentName = environmentName
+
+    def getEnvironmentName(self):
+        return self.environmentName
+
+
+class FakeUser(object):
+    def __init__(self, userId=7, email='dev@example.com', administrator=True):
+        self.userId = userId
+        self.email = email
+        self.administrator = administrator
+
+    def getID(self):
+        return self.userId
+
+    def getEmail(self):
+        return self.email
+
+    def getTimeZone(self):
+        return None
+
+    def isMember(self, groupName, context):
+        return self.administrator
+
+
+class FakeApplication(object):
+    """dataSourceRows: dicts of column -> value returned by every executeQueryFromDatasource() call"""
+    def __init__(self, name='DOCWORK', dataSourceRows=None):
+        self.name = name
+        self.dataSourceRows = dataSourceRows or []
+
+    def getName(self):
+        return self.name
+
+    def executeQueryFromDatasource(self, dataSource, params):
+        return FakeResultSet(self.dataSourceRows)
+
+
+class FakeResultSet(object):
+    """DAO-like cursor over a list of row dicts, as executeQueryFromDatasource() returns."""
+    def __init__(self, rows):
+        self.rows = rows
+        self._row = -1
+
+    def count(self):
+        return len(self.rows)
+
+    def next(self):
+        self._row += 1
+        return self._row < len(self.rows)
+
+    def getValue(self, column):
+        return self.rows[self._row].get(column)
+
+
+class FakeFieldSetting(object):
+    FIELD_TYPE_TEXT = 0
+    FIELD_TYPE_LINK = 1
+    FIELD_TYPE_ATTACHMENT = 2
+
+    def __init__(self, fieldType=0):
+        self.fieldType = fieldType
+
+    def getFieldType(self):
+        return self.fieldType
+
+
+class FakeDocLinks(object):
+    def __init__(self, descriptions):
+        self.descriptions = descriptions
+
+    def __len__(self):
+        return len(self.descriptions)
+
+    def getDescription(self, locale, timeZone):
+        return list(self.descriptions)
+
+
+class FakeField(object):
+    def __init__(self, value, fieldType=FakeFieldSetting.FIELD_TYPE_TEXT):
+        self.value = value
+        self.setting = FakeFieldSetting(fieldType)
+
+    def getSetting(self):
+        return self.setting
+
+    def getLocale(self):
+        return None
+
+    def getDocLinks(self):
+        return FakeDocLinks(self.value)
+
+    def getEncodedDisplayText(self):
+        return self.value
+
+    def getEncodedValue(self):
+        return self.value
+
+
+class FakeDocument(object):
+    """
+    A document with text fields and link fields (a list of link descriptions).
+    Each field lookup builds a new FakeField, like the platform's Java wrappers.
+    """
+    def __init__(self, fields=None, linkFields=None, formName='CAPA_DOCUMENT', application=None, documentId=1001):
+        self.fields = dict(fields or {})
+        self.linkFields = dict(linkFields or {})
+        self.formName = formName
+        self.application = application or FakeApplication()
+        self.documentId = documentId
+        self.fieldLookups = 0
+
+    def getID(self):
+        return self.documentId
+
+    def getFormName(self):
+        return self.formName
+
+    def getParentApplication(self):
+        return self.application
+
+    def getField(self, fieldName, *args):
+        self.fieldLookups += 1
+        if fieldName in self.linkFields:
+            return FakeField(self.linkFields[fieldName], FakeFieldSetting.FIELD_TYPE_LINK)
+        value = self.fields.get(fieldName)
+        return FakeField(value) if value is not None else None
+
+    def addWarning(self, text):
+        pass
+
+
+class FakePublicMail(object):
+    """PublicMail that stores whatever set*/add* calls it receives."""
+    def __init__(self):
+        self.values = {}
+        self.attachments = []
+
+    def __getattr__(self, name):
+        if name.startswith('set'):
+            def setter(value):
+                self.values[name[3:]] = value
+            return setter
+        raise AttributeError(name)
+
+    def addAttachment(self, attachment):
+        self.attachments.append(attachment)
+
+
+class FakePublicMailSender(object):
+    HIGHPRIORITY = 1
+    NORMALPRIORITY = 3
+    LOWPRIORITY = 5
+    sent = 0
+    bodyChars = 0
+
+    @classmethod
+    def sendEmail(cls, mailObj, sendFailureNotification):
+        cls.sent += 1
+        cls.bodyChars += len(mailObj.values.get('Body', ''))
+
+
+class FakeProfile(object):
+    def __init__(self, profileId):
+        self.profileId = profileId
+
+    def getID(self):
+        return self.profileId
+
+
+class FakeProfileManager(object):
+    def getUserProfile(self, name):
+        return FakeProfile(42)
+
+
+class FakePublicAttachment(object):
+    def setFileName(self, fileName):
+        self.fileName = fileName
+
+    def setContent(self, content):
+        self.content = content
+
+
+class FakeColumn(object):
+    def __init__(self, name):
+        self.name = name
+
+    def getName(self):
+        return self.name
+
+
+class FakeDao(object):
+    """
+    DAO over `rows` generated rows. Values are computed from the row index on
+    demand, so 100k-row results cost no memory up front.
+    latency: seconds each execute() sleeps, standing in for a database round trip
+    """
+    def __init__(self, rows=1000, columns=('ID', 'TITLE', 'STATUS', 'CREATED_BY', 'AMOUNT'), latency=0):
+        self.rows = rows
+        self.columns = tuple(columns)
+        self.latency = latency
+        self._columnIndex = dict((name, index) for index, name in enumerate(self.columns))
+        self._row = -1
+        self.executed = 0
+        self.closed = 0
+
+    def execute(self, query):
+        if self.latency:
+            time.sleep(self.latency)
+        self.executed += 1
+        self._row = -1
+
+    def getColumnCount(self):
+        return len(self.columns)
+
+    def getColumn(self, index):
+        return FakeColumn(self.columns[index])
+
+    def count(self):
+        return self.rows
+
+    def next(self):
+        self._row += 1
+        return self._row < self.rows
+
+    def getValue(self, column):
+        index = self._columnIndex.get(column, 0)
+        if index == 0:
+            return self._row + 1
+        return u'{}-{}'.format(column.lower(), self._row % 97)
+
+    def closeDatabaseConnection(self):
+        self.closed += 1
+
+
+class FakeDaoFactory(object):
+    """com.etq.reliance.dao.DaoFactory; every getDao() call returns a fresh FakeDao over `rows` rows."""
+    rows = 1000
+    columns = ('ID', 'TITLE', 'STATUS', 'CREATED_BY', 'AMOUNT')
+    latency = 0
+
+    @classmethod
+    def getInstance(cls):
+        return cls
+
+    @classmethod
+    def getDao(cls, applicationName):
+        return FakeDao(cls.rows, cls.columns, cls.latency)
+
+
+def installDaoFactory(rows=1000, columns=None, latency=0):
+    """Register FakeDaoFactory as com.etq.reliance.dao.DaoFactory for `from ... import DaoFactory`."""
+    FakeDaoFactory.rows = rows
+    FakeDaoFactory.latency = latency
+    if columns is not None:
+        FakeDaoFactory.columns = tuple(columns)
+    for name in ('com', 'com.etq', 'com.etq.reliance'):
+        sys.modules.setdefault(name, types.ModuleType(name))
+    module = sys.modules.get('com.etq.reliance.dao')
+    if module is None:
+        module = sys.modules['com.etq.reliance.dao'] = types.ModuleType('com.etq.reliance.dao')
+    module.DaoFactory = FakeDaoFactory
+    return FakeDaoFactory
+
+
+def makeDocument(textFields=20, linkFields=2, linksPerField=3):
+    """A FakeDocument with ETQ$NUMBER, FIELD_0..N text fields and LINK_0..N link fields."""
+    fields = {'ETQ$NUMBER': 'CAPA-00042', 'ETQ$TITLE': 'Benchmark document'}
+    for index in range(textFields):
+        fields['FIELD_{}'.format(index)] = u'value {}'.format(index)
+    links = {}
+    for index in range(linkFields):
+        links['LINK_{}'.format(index)] = [u'DOC-{}-{}'.format(index, link) for link in range(linksPerField)]
+    return FakeDocument(fields, links)
+
+
+def makeTableInfoRows(tableNames, columns=12, indexes=2, rowCount=5000):
+    """Rows of the databaseTablesInfo() UNION ALL metadata query for `tableNames`."""
+    rows = []
+    for tableName in tableNames:
+        base = {'TABLE_NAME': tableName, 'V1': None, 'V2': None, 'V3': None, 'V4': None, 'V5': None, 'N1': None}
+        for index in range(columns):
+            rows.append(dict(base, KIND='column', GROUP_KEY='', SEQ=index + 1, V1='COLUMN_{}'.format(index), V2='varchar', V3=255, V4='YES', V5='PRI' if index == 0 else ''))
+        for index in range(indexes):
+            rows.append(dict(base, KIND='index', GROUP_KEY='IX_{}'.format(index), SEQ=1, V1='COLUMN_{}'.format(index), V2=int(index > 0)))
+        rows.append(dict(base, KIND='constraint', GROUP_KEY='PK_{}'.format(tableName), SEQ=1, V1='PRIMARY KEY', V2='COLUMN_0'))
+        rows.append(dict(base, KIND='rows', GROUP_KEY='', SEQ=0, N1=rowCount))
+    return rows
+
+
+def makeGlobals(document=None, environmentName='production', administrator=True):
+    """The injected globals of an EtQScript, built from the fakes above."""
+    application = FakeApplication()
+    return {
+        '__name__': 'etqDebug',
+        'engineConfig': FakeEngineConfig(environmentName),
+        'thisUser': FakeUser(administrator=administrator),
+        'thisDocument': document if document is not None else makeDocument(),
+        'thisApplication': application,
+        'Rutilities': FakeRutilities,
+        'PublicMail': FakePublicMail,
+        'PublicMailSender': FakePublicMailSender,
+        'PublicECCProfileManager': FakeProfileManager,
+        'PublicAttachment': FakePublicAttachment,
+    }
+
+
+def loadEtqDebug(path=ETQ_DEBUG_PATH, rows=1000, **overrides):
+    """
+    Exec etqDebug.py with the fake globals (plus `overrides`) and return the namespace.
+    The fake DAO factory is installed over `rows` rows.
+    """
+    installDaoFactory(rows)
+    namespace = makeGlobals()
+    namespace.update(overrides)
+    with open(path) as source:
+        code = compile(source.read(), os.path.abspath(path), 'exec')
+    exec(code, namespace)
+    return namespace
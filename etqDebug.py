@@ -1,4 +1,833 @@
-import traceback
+import sys
+import time
+import types
+import threading
+import collections
+import contextlib
+import copy
+import random
+import itertools
+
+
+class EtqDebugRecord(object):
+    """
+    One emitted log() call, formatted once and shared by every sink.
+    - timestamp: time.time() when emitted
+    - level: integer index into EtqDebug.LEVEL_ORDER
+    - label: instance label with {FIELD} values resolved
+    - caller: 'func() line=N' or '' when caller info is off
+    - message: formatted, field-resolved lines (a list, or a one-shot generator of blocks
+      for streamed multiple=True output; EtqDebugMultiSink materializes it once)
+    - documentId: ID of the document used for field substitution, if any
+    """
+    __slots__ = ('timestamp', 'level', 'label', 'caller', 'message', 'documentId')
+
+    def __init__(self, timestamp, level, label, caller, message, documentId=None):
+        self.timestamp = timestamp
+        self.level = level
+        self.label = label
+        self.caller = caller
+        self.message = message
+        self.documentId = documentId
+
+    def levelName(self):
+        return EtqDebug.LEVEL_ORDER[self.level]
+
+
+class EtqDebugSink(object):
+    """
+    Default log sink: writes every formatted line to Rutilities.debug with its header,
+    exactly as EtqDebug.log() always has.
+    Text sinks render the record header with renderHeader() and implement write(header, lines).
+    metrics: EtqDebugMetrics credited with the characters written (set by EtqDebug when metrics are on)
+    """
+    metrics = None
+
+    def emit(self, record):
+        self.write(self.renderHeader(record), record.message)
+
+    def renderHeader(self, record, delimiter='\n'):
+        """The '[LEVEL] label' / 'func() line=N:' header of the classic text output."""
+        header = u'{}[{}] {}'.format(delimiter, EtqDebug.LEVEL_MAP[record.levelName()]['display'], record.label)
+        if record.caller:
+            header += u'{}{}:'.format(delimiter, record.caller)
+        return header
+
+    def write(self, header, lines):
+        for line in lines:
+            text = header + '\n' + line
+            Rutilities.debug(text)
+            if self.metrics is not None:
+                self.metrics.addChars('debug', len(text))
+
+    def flush(self):
+        pass
+
+
+class EtqDebugMultiSink(object):
+    """Sends each record to several sinks (e.g. text + JSON lines) without formatting it twice."""
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+
+    def emit(self, record):
+        if not isinstance(record.message, list):
+            record.message = list(record.message)
+        for sink in self.sinks:
+            sink.emit(record)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+
+class EtqDebugJsonLinesSink(object):
+    """
+    Appends records to a local file as JSON lines:
+        {"ts": ..., "level": 0, "levelName": "debug", "label": ..., "caller": ..., "message": ..., "documentId": ...}
+    - bufferLines: records kept in memory before a write (flush() writes immediately)
+    - maxBytes / maxAge: rotate when the file reaches maxBytes or is older than maxAge seconds
+    - backups: rotated files kept as path.1, path.2, ... (path.1.gz ... when compress=True)
+    """
+    metrics = None
+
+    def __init__(self, path, bufferLines=100, maxBytes=10 * 1024 * 1024, maxAge=None, backups=5, compress=False):
+        self.path = path
+        self.bufferLines = bufferLines
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.backups = backups
+        self.compress = compress
+        self._lock = threading.RLock()
+        self._buffer = []
+        self._file = None
+        self._size = 0
+        self._openedAt = None
+
+    def emit(self, record):
+        import json
+        message = record.message if isinstance(record.message, list) else list(record.message)
+        line = json.dumps({
+            'ts': record.timestamp,
+            'level': record.level,
+            'levelName': record.levelName(),
+            'label': record.label,
+            'caller': record.caller,
+            'message': u'\n'.join(message),
+            'documentId': record.documentId
+        }, ensure_ascii=False)
+        if isinstance(line, unicode):
+            line = line.encode('utf-8')
+        with self._lock:
+            self._buffer.append(line)
+            if len(self._buffer) >= self.bufferLines:
+                self._writeBuffer()
+
+    def flush(self):
+        with self._lock:
+            self._writeBuffer()
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _open(self):
+        import os
+        self._file = open(self.path, 'ab')
+        self._size = os.path.getsize(self.path)
+        self._openedAt = time.time()
+        if self._size and self.maxAge:
+            # Age an existing file from its modification time
+            self._openedAt = min(self._openedAt, os.path.getmtime(self.path))
+
+    def _writeBuffer(self):
+        if not self._buffer:
+            return
+        if self._file is None:
+            self._open()
+        if self._needsRotation():
+            self._rotate()
+        data = '\n'.join(self._buffer) + '\n'
+        self._buffer = []
+        self._file.write(data)
+        self._size += len(data)
+        if self.metrics is not None:
+            self.metrics.addChars('file', len(data))
+
+    def _needsRotation(self):
+        if self._size == 0:
+            return False
+        if self.maxBytes and self._size >= self.maxBytes:
+            return True
+        return bool(self.maxAge) and time.time() - self._openedAt >= self.maxAge
+
+    def _rotate(self):
+        import os
+        self._file.close()
+        suffix = '.gz' if self.compress else ''
+        for index in range(self.backups - 1, 0, -1):
+            source = '{}.{}{}'.format(self.path, index, suffix)
+            if os.path.exists(source):
+                target = '{}.{}{}'.format(self.path, index + 1, suffix)
+                if os.path.exists(target):
+                    os.remove(target)
+                os.rename(source, target)
+        first = '{}.1'.format(self.path)
+        if self.backups < 1:
+            os.remove(self.path)
+        elif self.compress:
+            import gzip
+            import shutil
+            source = open(self.path, 'rb')
+            try:
+                target = gzip.open(first + '.gz', 'wb')
+                try:
+                    shutil.copyfileobj(source, target)
+                finally:
+                    target.close()
+            finally:
+                source.close()
+            os.remove(self.path)
+        else:
+            if os.path.exists(first):
+                os.remove(first)
+            os.rename(self.path, first)
+        self._open()
+
+
+class EtqDebugBufferedSink(EtqDebugSink):
+    """
+    Collects log records and writes them to Rutilities.debug as one block.
+    Each record keeps its header once, followed by all of its lines.
+    Flushes when maxLines or maxBytes is reached, on flush(), or when a
+    `with EtqDebug(...)` block exits.
+    perThread=True keeps a separate buffer per thread (flush() only flushes the calling thread).
+    """
+    def __init__(self, maxLines=500, maxBytes=64 * 1024, perThread=False):
+        self.maxLines = maxLines
+        self.maxBytes = maxBytes
+        self.perThread = perThread
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._shared = self._newBuffer()
+
+    def _newBuffer(self):
+        return {'parts': [], 'lines': 0, 'bytes': 0}
+
+    def _getBuffer(self):
+        if not self.perThread:
+            return self._shared
+        buf = getattr(self._local, 'buffer', None)
+        if buf is None:
+            buf = self._local.buffer = self._newBuffer()
+        return buf
+
+    def write(self, header, lines):
+        with self._lock:
+            buf = self._getBuffer()
+            parts = buf['parts']
+            parts.append(header)
+            size = len(header)
+            count = 0
+            for line in lines:
+                parts.append(line)
+                size += len(line) + 1
+                count += 1
+            buf['lines'] += count
+            buf['bytes'] += size
+            if buf['lines'] >= self.maxLines or buf['bytes'] >= self.maxBytes:
+                self._flushBuffer(buf)
+
+    def _flushBuffer(self, buf):
+        if buf['parts']:
+            block = u'\n'.join(buf['parts'])
+            buf['parts'] = []
+            buf['lines'] = 0
+            buf['bytes'] = 0
+            Rutilities.debug(block)
+            if self.metrics is not None:
+                self.metrics.addChars('debug', len(block))
+
+    def flush(self):
+        with self._lock:
+            self._flushBuffer(self._getBuffer())
+
+
+class EtqDebugEmailDigest(object):
+    """
+    Collects EtqDebug.email() messages and releases them as one consolidated mail per recipient.
+    - Identical subject/body pairs are stored once with an occurrence count
+    - Messages with different CC recipients, priority or failure notification go to separate
+      digest mails; the document link is kept per message and set on the digest mail only when
+      every message in it came from the same document
+    - window: seconds after the first queued message before the digest is sent automatically
+    - maxPerPeriod / period: per-recipient limit on automatic digest mails; recipients over the
+      limit keep accumulating until the period rolls over or flush() is called
+    """
+    def __init__(self, window=300, maxPerPeriod=4, period=3600, maxEntries=200):
+        self.window = window
+        self.maxPerPeriod = maxPerPeriod
+        self.period = period
+        self.maxEntries = maxEntries
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._sent = {}
+        self._windowStart = None
+
+    def add(self, recipients, subject, body, mailOptions):
+        with self._lock:
+            if self._windowStart is None:
+                self._windowStart = time.time()
+            key = (recipients, self._optionsKey(mailOptions))
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = {'recipients': recipients, 'entries': {}, 'order': [], 'mailOptions': mailOptions, 'sameDocument': True, 'dropped': 0}
+            fingerprint = (subject, body)
+            entry = pending['entries'].get(fingerprint)
+            if entry is not None:
+                entry['count'] += 1
+                entry['last'] = time.time()
+            elif len(pending['order']) >= self.maxEntries:
+                pending['dropped'] += 1
+            else:
+                pending['entries'][fingerprint] = {'subject': subject, 'body': body, 'count': 1, 'first': time.time(), 'last': time.time()}
+                pending['order'].append(fingerprint)
+            if mailOptions.get('document') is not pending['mailOptions'].get('document'):
+                pending['sameDocument'] = False
+
+    @staticmethod
+    def _optionsKey(mailOptions):
+        """Hashable form of the mail options that must match for two messages to share a digest mail."""
+        return (
+            tuple(mailOptions.get('copyToEmails') or ()),
+            tuple(mailOptions.get('copyUserIds') or ()),
+            mailOptions.get('priority'),
+            mailOptions.get('sendFailureNotification', True)
+        )
+
+    def isDue(self):
+        return self._windowStart is not None and time.time() - self._windowStart >= self.window
+
+    def pendingCount(self):
+        """Number of queued messages, duplicates included."""
+        with self._lock:
+            return sum(sum(e['count'] for e in p['entries'].values()) + p['dropped'] for p in self._pending.values())
+
+    def _isRateLimited(self, recipients, now):
+        sent = [t for t in self._sent.get(recipients, []) if now - t < self.period]
+        self._sent[recipients] = sent
+        return len(sent) >= self.maxPerPeriod
+
+    def drain(self, force=False):
+        """
+        Remove and return (recipients, subject, body, mailOptions) for each digest mail to send.
+        force=True ignores the rate limit (used by EtqDebug.flush()).
+        """
+        with self._lock:
+            now = time.time()
+            mails = []
+            for key in list(self._pending.keys()):
+                recipients = self._pending[key]['recipients']
+                if not force and self._isRateLimited(recipients, now):
+                    continue
+                pending = self._pending.pop(key)
+                mails.append(self._render(recipients, pending))
+                self._sent.setdefault(recipients, []).append(now)
+            self._windowStart = now if self._pending else None
+            return mails
+
+    def _render(self, recipients, pending):
+        entries = [pending['entries'][fingerprint] for fingerprint in pending['order']]
+        total = sum(entry['count'] for entry in entries) + pending['dropped']
+        subject = u'[DIGEST] {} message(s), {} unique: {}'.format(total, len(entries), entries[0]['subject'])
+        sections = []
+        for entry in entries:
+            sections.append(u'<b>{}</b> (x{}, first {}, last {})<br>{}'.format(
+                entry['subject'], entry['count'],
+                time.strftime('%H:%M:%S', time.localtime(entry['first'])),
+                time.strftime('%H:%M:%S', time.localtime(entry['last'])),
+                entry['body']))
+        if pending['dropped']:
+            sections.append(u'... {} more message(s) not shown'.format(pending['dropped']))
+        mailOptions = pending['mailOptions']
+        if not pending['sameDocument']:
+            mailOptions = dict(mailOptions, document=None)
+        return recipients, subject, u'<hr>'.join(sections), mailOptions
+
+
+class EtqDebugMailWorkerPool(object):
+    """
+    Sends built PublicMail objects on a small pool of background threads so email()
+    does not block the calling script on PublicMailSender.sendEmail.
+    - maxQueue: bounded queue size
+    - policy: 'drop-oldest' discards the oldest queued mail when full, 'block' waits
+      up to blockTimeout seconds for space (then drops the new mail)
+    - retries / backoff: failed sends are retried with backoff * 2**attempt second delays
+    - mailer: callable(mailObj, sendFailureNotification); defaults to PublicMailSender.sendEmail
+    - idleTimeout: seconds a worker waits for work before exiting (None = until shutdown());
+      workers are started again by the next submit()
+    """
+    def __init__(self, workers=2, maxQueue=100, policy='drop-oldest', retries=2, backoff=0.5, blockTimeout=5, mailer=None, idleTimeout=60):
+        if policy not in ('drop-oldest', 'block'):
+            raise ValueError('policy must be "drop-oldest" or "block"')
+        self.workers = workers
+        self.maxQueue = maxQueue
+        self.policy = policy
+        self.retries = retries
+        self.backoff = backoff
+        self.blockTimeout = blockTimeout
+        self._mailer = mailer
+        self.idleTimeout = idleTimeout
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._inFlight = 0
+        self._counters = {'queued': 0, 'sent': 0, 'failed': 0, 'dropped': 0, 'retried': 0}
+
+    def submit(self, mailObj, sendFailureNotification=True, onFailure=None):
+        """Queue a mail. onFailure(mailObj, error) is called from a worker after the last retry fails."""
+        with self._condition:
+            self._stopping = False
+            self._startWorkers()
+            if len(self._queue) >= self.maxQueue:
+                if self.policy == 'drop-oldest':
+                    self._queue.popleft()
+                    self._counters['dropped'] += 1
+                else:
+                    deadline = time.time() + self.blockTimeout
+                    while len(self._queue) >= self.maxQueue and time.time() < deadline:
+                        self._condition.wait(deadline - time.time())
+                    if len(self._queue) >= self.maxQueue:
+                        self._counters['dropped'] += 1
+                        return False
+            self._queue.append((mailObj, sendFailureNotification, onFailure))
+            self._counters['queued'] += 1
+            self._condition.notify_all()
+            return True
+
+    def _startWorkers(self):
+        while len(self._threads) < self.workers:
+            worker = threading.Thread(target=self._run, name='EtqDebugMailWorker-{}'.format(len(self._threads)))
+            worker.setDaemon(True)
+            self._threads.append(worker)
+            worker.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                idleSince = time.time()
+                while not self._queue:
+                    idle = time.time() - idleSince
+                    if self._stopping or (self.idleTimeout is not None and idle >= self.idleTimeout):
+                        # Leave the pool; submit() starts a replacement when work arrives
+                        self._threads.remove(threading.currentThread())
+                        self._condition.notify_all()
+                        return
+                    self._condition.wait(self.idleTimeout - idle if self.idleTimeout is not None else None)
+                mailObj, sendFailureNotification, onFailure = self._queue.popleft()
+                self._inFlight += 1
+                self._condition.notify_all()
+            try:
+                self._deliver(mailObj, sendFailureNotification, onFailure)
+            finally:
+                with self._condition:
+                    self._inFlight -= 1
+                    self._condition.notify_all()
+
+    def _deliver(self, mailObj, sendFailureNotification, onFailure):
+        mailer = self._mailer or PublicMailSender.sendEmail
+        for attempt in range(self.retries + 1):
+            try:
+                mailer(mailObj, sendFailureNotification)
+                with self._condition:
+                    self._counters['sent'] += 1
+                return
+            except Exception as e:
+                error = e
+                if attempt < self.retries:
+                    with self._condition:
+                        self._counters['retried'] += 1
+                    time.sleep(self.backoff * (2 ** attempt))
+        with self._condition:
+            self._counters['failed'] += 1
+        if onFailure is not None:
+            try:
+                onFailure(mailObj, error)
+            except Exception:
+                pass
+
+    def join(self, timeout=None):
+        """Wait until the queue is empty and no send is in flight. Returns False on timeout."""
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._queue or self._inFlight:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def shutdown(self, wait=True, timeout=None):
+        """
+        Stop the workers once the queued mails are sent. wait=True blocks until they have exited
+        (returns False on timeout). The pool stays usable: the next submit() starts new workers.
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+            while wait and self._threads:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def stats(self):
+        """Return queued/sent/failed/dropped/retried counters and the current queue depth."""
+        with self._condition:
+            stats = dict(self._counters)
+            stats['pending'] = len(self._queue) + self._inFlight
+            return stats
+
+
+class EtqDebugSampler(object):
+    """
+    Low-overhead sampling profiler: a background thread snapshots one target thread's stack
+    every `interval` seconds via sys._current_frames(). The target thread is never traced,
+    so it runs at (almost) full speed. Aggregates into a top-N self/cumulative table or
+    collapsed stacks ("root;child;leaf count") for flame graph tools.
+    """
+    def __init__(self, interval=0.005, maxDepth=64, threadId=None):
+        self.interval = interval
+        self.maxDepth = maxDepth
+        self.threadId = threadId
+        self.samples = 0
+        self._stacks = {}
+        self._labels = {}
+        self._stopEvent = threading.Event()
+        self._thread = None
+        self._startedAt = None
+        self.elapsed = 0.0
+
+    def start(self):
+        if not hasattr(sys, '_current_frames'):
+            raise RuntimeError('sys._current_frames() is not available on this interpreter')
+        if self.threadId is None:
+            self.threadId = threading.current_thread().ident
+        self._stopEvent.clear()
+        self._startedAt = time.time()
+        self._thread = threading.Thread(target=self._run, name='EtqDebugSampler')
+        self._thread.setDaemon(True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopEvent.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._startedAt is not None:
+            self.elapsed += time.time() - self._startedAt
+            self._startedAt = None
+        return self
+
+    def _run(self):
+        while not self._stopEvent.wait(self.interval):
+            frame = sys._current_frames().get(self.threadId)
+            if frame is not None:
+                self._record(frame)
+
+    def _record(self, frame):
+        stack = []
+        while frame is not None and len(stack) < self.maxDepth:
+            stack.append(frame.f_code)
+            frame = frame.f_back
+        stack = tuple(reversed(stack))
+        self._stacks[stack] = self._stacks.get(stack, 0) + 1
+        self.samples += 1
+
+    def _label(self, code):
+        label = self._labels.get(code)
+        if label is None:
+            fileName = code.co_filename.replace('\\', '/').split('/')[-1]
+            label = self._labels[code] = '{} ({}:{})'.format(code.co_name, fileName, code.co_firstlineno)
+        return label
+
+    def report(self, top=20, sortBy='cumulative'):
+        """Return the top-N functions by 'cumulative' or 'self' samples as text lines."""
+        selfCounts = {}
+        cumulativeCounts = {}
+        for stack, count in self._stacks.items():
+            selfCounts[stack[-1]] = selfCounts.get(stack[-1], 0) + count
+            for code in set(stack):
+                cumulativeCounts[code] = cumulativeCounts.get(code, 0) + count
+
+        primary = cumulativeCounts if sortBy == 'cumulative' else selfCounts
+        ranked = sorted(cumulativeCounts.keys(), key=lambda code: (-primary.get(code, 0), self._label(code)))
+        total = float(self.samples) or 1.0
+        lines = ['{} samples every {:.1f} ms over {:.2f} s'.format(self.samples, self.interval * 1000.0, self.elapsed),
+                 '  self%   cum%  self   cum  function']
+        for code in ranked[:top]:
+            lines.append('{:6.1f} {:6.1f} {:5d} {:5d}  {}'.format(
+                selfCounts.get(code, 0) * 100 / total, cumulativeCounts[code] * 100 / total,
+                selfCounts.get(code, 0), cumulativeCounts[code], self._label(code)))
+        return lines
+
+    def collapsed(self):
+        """Return samples as collapsed stacks ("root;child;leaf count"), one line per unique stack."""
+        return sorted('{} {}'.format(';'.join(self._label(code) for code in stack), count) for stack, count in self._stacks.items())
+
+
+class EtqDebugProfileAccumulator(object):
+    """
+    Merged profile for many calls of one @profileThis function: call count, wall-time
+    percentiles over every call, and one pstats.Stats built from the profiled calls.
+    """
+    def __init__(self, name, every=None, threshold=None, maxDurations=5000):
+        self.name = name
+        self.every = every
+        self.threshold = threshold
+        self.maxDurations = maxDurations
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.profiledCalls = 0
+        self.durations = []
+        self.stats = None
+
+    def shouldProfile(self):
+        """Count a call and decide whether to profile it (the first of every N calls)."""
+        self.calls += 1
+        return not self.every or (self.calls - 1) % self.every == 0
+
+    def addDuration(self, seconds):
+        self.addSample(self.durations, self.maxDurations, self.calls, seconds)
+
+    @staticmethod
+    def addSample(samples, maxSamples, seen, value):
+        """Add the `seen`-th value to a list of at most maxSamples values."""
+        if len(samples) < maxSamples:
+            samples.append(value)
+        else:
+            # Reservoir sampling keeps the percentiles representative without unbounded growth
+            index = random.randint(0, seen - 1)
+            if index < maxSamples:
+                samples[index] = value
+
+    def addProfile(self, profiler, seconds):
+        """Merge a profiled call unless it finished under the threshold."""
+        if self.threshold is not None and seconds < self.threshold:
+            return
+        import pstats
+        if self.stats is None:
+            self.stats = pstats.Stats(profiler)
+        else:
+            self.stats.add(profiler)
+        self.profiledCalls += 1
+
+    def report(self, top=None):
+        """Return the summary and merged stats as text lines."""
+        from StringIO import StringIO
+        durations = sorted(self.durations)
+        lines = ['calls={} profiled={} every={} threshold={}'.format(self.calls, self.profiledCalls, self.every, self.threshold)]
+        if durations:
+            lines.append('wall ms: min={:.2f} p50={:.2f} p90={:.2f} p99={:.2f} max={:.2f}'.format(
+                durations[0] * 1000, EtqDebug._percentile(durations, 50) * 1000, EtqDebug._percentile(durations, 90) * 1000,
+                EtqDebug._percentile(durations, 99) * 1000, durations[-1] * 1000))
+        if self.stats is not None:
+            s = StringIO()
+            self.stats.stream = s
+            self.stats.sort_stats('cumulative')
+            if top:
+                self.stats.print_stats(top)
+            else:
+                self.stats.print_stats()
+            lines += s.getvalue().strip().split('\n')
+        return lines
+
+
+class EtqDebugMetrics(object):
+    """
+    Counters for EtqDebug's own cost; pass the same object to several instances to share them.
+    - log() calls per level and per call site: emitted, filtered (below minLevel), throttled
+    - characters written per channel: 'debug' (Rutilities.debug), 'file' (JSON lines), 'email',
+      plus 'message' (formatted log() message text, also credited to its call site)
+    - seconds spent formatting messages, substituting {FIELD} values and sending (sink writes, sendEmail)
+    - hits/misses per cache ('caller', 'template', 'field', 'schema')
+    Counters are updated without locking, so totals are approximate under heavy multi-threaded use.
+    - interval: seconds between automatic summary records (None = only on flush());
+      the clock is checked every CHECK_EVERY calls, so the hot path stays free of time lookups
+    - dumpOnFlush: also write the summary record on EtqDebug.flush() / `with` exit
+    - topSites: call sites listed in the summary
+    """
+    EMITTED, FILTERED, THROTTLED = 0, 1, 2
+    CHECK_EVERY = 256
+
+    def __init__(self, interval=300, dumpOnFlush=True, topSites=10):
+        self.interval = interval
+        self.dumpOnFlush = dumpOnFlush
+        self.topSites = topSites
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.nextDump = self.started + self.interval if self.interval else None
+        self.calls = 0
+        # [emitted, filtered, throttled] per level index
+        self.levels = [[0, 0, 0] for level in EtqDebug.LEVEL_ORDER]
+        # (id(code object), line) -> [emitted, filtered, throttled, message chars, code object]
+        # (code objects hash by content in Jython/CPython 2, so their id is the cheap key)
+        self.sites = {}
+        self.chars = {}
+        self.seconds = {'format': 0.0, 'substitute': 0.0, 'send': 0.0}
+        # cache name -> [hits, misses]
+        self.caches = {}
+
+    def countCall(self, levelIndex, site, outcome):
+        """Count one log() call; returns True when a periodic summary record is due."""
+        self.calls += 1
+        self.levels[levelIndex][outcome] += 1
+        if site is not None:
+            key = (id(site[0]), site[1])
+            counts = self.sites.get(key)
+            if counts is None:
+                counts = self.sites[key] = [0, 0, 0, 0, site[0]]
+            counts[outcome] += 1
+        return self.nextDump is not None and self.calls % self.CHECK_EVERY == 0 and time.time() >= self.nextDump
+
+    def addChars(self, channel, count, site=None):
+        self.chars[channel] = self.chars.get(channel, 0) + count
+        if site is not None:
+            counts = self.sites.get((id(site[0]), site[1]))
+            if counts is not None:
+                counts[3] += count
+
+    def addSeconds(self, kind, seconds):
+        self.seconds[kind] += seconds
+
+    def cacheLookup(self, name, hit):
+        counts = self.caches.get(name)
+        if counts is None:
+            counts = self.caches[name] = [0, 0]
+        counts[0 if hit else 1] += 1
+
+    def stats(self, top=None):
+        """
+        Snapshot as plain dicts: 'since', 'elapsed', 'levels', 'chars', 'seconds', 'caches' and 'sites'
+        (the `top` busiest call sites, default topSites, by total calls then characters).
+        """
+        top = self.topSites if top is None else top
+        outcome = lambda counts: {'emitted': counts[0], 'filtered': counts[1], 'throttled': counts[2]}
+        sites = []
+        for (codeId, lineno), counts in list(self.sites.items()):
+            code = counts[4]
+            site = outcome(counts)
+            site.update({'site': '{}() line={}'.format(code.co_name, lineno), 'file': code.co_filename, 'chars': counts[3], 'calls': sum(counts[:3])})
+            sites.append(site)
+        sites.sort(key=lambda site: (site['calls'], site['chars']), reverse=True)
+        return {
+            'since': self.started,
+            'elapsed': time.time() - self.started,
+            'levels': dict((EtqDebug.LEVEL_ORDER[index], outcome(counts)) for index, counts in enumerate(self.levels) if any(counts)),
+            'chars': dict(self.chars),
+            'seconds': dict(self.seconds),
+            'caches': dict((name, {'hits': hits, 'misses': misses, 'hitRate': float(hits) / (hits + misses) if hits + misses else 0.0})
+                           for name, (hits, misses) in list(self.caches.items())),
+            'sites': sites[:top] if top else sites
+        }
+
+
+class EtqDebugTimedDao(object):
+    """
+    DAO wrapper used by executeQuery instrumentation: next() is timed and counts fetched rows.
+    getValue is bound directly and everything else is delegated, so only next() pays for the timing.
+    """
+    def __init__(self, dao):
+        self._dao = dao
+        self.getValue = dao.getValue
+        self.fetchSeconds = 0.0
+        self.rows = 0
+
+    def next(self):
+        start = time.time()
+        found = self._dao.next()
+        self.fetchSeconds += time.time() - start
+        if found:
+            self.rows += 1
+        return found
+
+    def __getattr__(self, name):
+        return getattr(self._dao, name)
+
+
+class EtqDebugNullSpan(object):
+    """
+    No-op span returned by EtqDebug.span() when debug logging is off.
+    Used as a decorator it still wraps the function, so the level is checked on every call.
+    """
+    def __init__(self, debug, name):
+        self._debug = debug
+        self.name = name
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        return False
+
+    def __call__(self, func):
+        return EtqDebugSpan.wrap(self._debug, self.name, func)
+
+
+class EtqDebugSpan(object):
+    """
+    One timed block from EtqDebug.span(). Records wall and CPU time under its path
+    (the names of the enclosing spans on this thread plus its own).
+    Used as a decorator it opens a fresh span on every call.
+    """
+    def __init__(self, debug, name):
+        self._debug = debug
+        self.name = name
+
+    def __enter__(self):
+        stack = self._debug._getSpanStack()
+        self.path = (stack[-1].path if stack else ()) + (self.name,)
+        stack.append(self)
+        self._cpuStart = EtqDebug._cpuTime()
+        self._start = time.time()
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        wall = time.time() - self._start
+        cpu = EtqDebug._cpuTime() - self._cpuStart
+        stack = self._debug._getSpanStack()
+        if stack and stack[-1] is self:
+            stack.pop()
+        self._debug._recordSpan(self.path, wall, cpu)
+        return False
+
+    def __call__(self, func):
+        return self.wrap(self._debug, self.name, func)
+
+    @staticmethod
+    def wrap(debug, name, func):
+        """Wrap func so every call runs inside debug.span(name)."""
+        import functools
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with debug.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+
 class EtqDebug(object):
     LEVEL_ORDER = ['debug', 'info', 'warn', 'error', 'none']
     LEVEL_MAP = {
@@ -8,13 +837,69 @@ class EtqDebug(object):
         'error': {'display': 'ERROR', 'aliases': ['error']},
         'none': {'display': 'NONE', 'aliases': ['none', 'off', 'disabled']}
     }     
-    def __init__(self, label=None, minLevel=None, document=None, enabled=True, className=None, **kwargs):              
-        env = engineConfig.getEnvironmentName()        
-        isProd = env.lower() in ['production', 'prod']
-        
-        # Default minimum level (e.g., from config)
+
+    # Alias -> position in LEVEL_ORDER (keep in sync with LEVEL_MAP aliases)
+    LEVEL_INDEX = {
+        'debug': 0,
+        'info': 1, 'information': 1,
+        'warn': 2, 'warning': 2,
+        'error': 3,
+        'none': 4, 'off': 4, 'disabled': 4
+    }
+    _errorIndex = LEVEL_INDEX['error']
+    _noneIndex = LEVEL_INDEX['none']
+
+    # Formatted caller prefixes keyed by (code object, line, className); kept per script run
+    # (not in _getProcessCache) so the cache never holds code objects of earlier scripts
+    CALLER_CACHE_SIZE = 2048
+    _callerCache = {}
+    # Seconds a cached field value stays valid across log()/email() calls
+    # (None = values are only reused within one call, unless fieldCacheMarker is set)
+    FIELD_CACHE_TTL = None
+    # Compiled {FIELD} templates keyed by format string, in the process-wide 'templates' cache
+    TEMPLATE_CACHE_SIZE = 1024
+    # Piped table column alignment
+    _ALIGN_FUNCS = {
+        'left': lambda s, w: s.ljust(w),
+        'center': lambda s, w: s.center(w),
+        'right': lambda s, w: s.rjust(w)
+    }
+    # Limits for multiple=True output (0 = no limit); see _iterFormatLines
+    FORMAT_MAX_DEPTH = 1
+    FORMAT_MAX_ITEMS = 1000
+    FORMAT_MAX_BYTES = 1024 * 1024
+    # Inline (not expanded) values: characters shown before '...' and container levels before '[...]'
+    FORMAT_MAX_VALUE_BYTES = 16 * 1024
+    FORMAT_INLINE_DEPTH = 5
+    _INLINE_BRACKETS = ((dict, '{', '}'), (list, '[', ']'), (tuple, '(', ')'), (frozenset, 'frozenset([', '])'), (set, 'set([', '])'))
+    # Size of each block log() hands to the sink for multiple=True output
+    FORMAT_BLOCK_BYTES = 32 * 1024
+    # Wall times kept per span path for the p95 column
+    SPAN_MAX_SAMPLES = 5000
+    # JVM ThreadMXBean used by _cpuTime() (None = not looked up yet, False = unavailable)
+    _threadCpuBean = None
+    # Seconds databaseTablesInfo() results stay in the process-wide schema cache
+    SCHEMA_CACHE_TTL = 600
+    # executeQuery() runs taking at least this many ms (execute + fetch) go to the slow-query log (None = off)
+    SLOW_QUERY_MS = 1000
+    # Distinct query fingerprints kept in the process-wide slow-query log
+    SLOW_QUERY_MAX_ENTRIES = 500
+    # Seconds a toGroup design name -> profile ID lookup stays in the process-wide cache (misses are not cached)
+    GROUP_CACHE_TTL = 300
+    # Seconds the environment name and per-user ADMINISTRATORS decision stay in the process-wide cache
+    ENVIRONMENT_CACHE_TTL = 300
+    ROLE_CACHE_TTL = 300
+    # Document IDs remembered per instance for sink records
+    DOCUMENT_ID_CACHE_SIZE = 256
+    # forDocument() instances kept per class for this script run (not process-wide: an
+    # instance holds its document and sink, which must not outlive the script)
+    INSTANCE_CACHE_SIZE = 64
+    _instances = {}
+
+    def __init__(self, label=None, minLevel=None, document=None, enabled=True, className=None, fieldCacheTtl=None, fieldCacheMarker=None, sink=None, emailDigest=None, mailPool=None, flightRecorder=None, metrics=None, **kwargs):              
+        # Default minimum level (e.g., from config); environment and role are cached process-wide
         if minLevel is None:
-            minLevel = 'debug' if (not isProd or thisUser.isMember('ADMINISTRATORS',None)) else 'error'
+            minLevel = 'debug' if (not self._isProduction() or self._isAdministrator()) else 'error'
 
         # Add backwards compatability by giving a purpose to the enabled parameter
         if not enabled:
@@ -27,32 +912,145 @@ class EtqDebug(object):
 
         self.className = className
 
-        if not label:
-            if self._document is not None:
-                formName = self._document.getFormName()
-                applicationName = self._document.getParentApplication().getName()
-                label = '{} - {} #{}'.format(applicationName, formName, '{ETQ$NUMBER}')
-        self._label = self._getFieldsInString(label)    
+        # Optional EtqDebugMetrics (True = a new one); None keeps every metrics hook to a single check
+        self._metrics = EtqDebugMetrics() if metrics is True else metrics
+        # Where log records go (EtqDebugSink writes straight to Rutilities.debug); a list fans out to several sinks
+        self._sink = self._makeSink(sink)
+        # id(document) -> (document, document ID) for sink records
+        self._documentIds = {}
+        # Optional EtqDebugEmailDigest; when set, email() queues instead of sending
+        self._emailDigest = emailDigest
+        # Optional EtqDebugMailWorkerPool; when set, mails are sent from background threads
+        self._mailPool = mailPool
+        # (mailObj, error) for pool sends that failed on a worker thread, logged by _reportMailFailures
+        self._mailFailures = collections.deque()
+        # DAO held open by daoSession() on each thread (see _getSessionDao)
+        self._daoLocal = threading.local()
+        # (EtqDebugProfileAccumulator, top) pairs for accumulating @profileThis functions
+        self._profileAccumulators = []
+        # Span path tuple -> [count, totalWall, minWall, maxWall, totalCpu, wallSamples]
+        self._spanStats = {}
+        self._spanLock = threading.Lock()
+        self._spanLocal = threading.local()
+        self._exitReportRegistered = False
+        # (code object, line) -> throttle state for log(every=, perSecond=, collapse=)
+        self._throttleState = {}
+        # Collapsed call sites holding an unlogged "repeated Nx" count, by site
+        self._pendingRepeats = {}
+        # Per-thread ring buffers of filtered-out records (see setFlightRecorder)
+        self._flightLocal = threading.local()
+        self.setFlightRecorder(flightRecorder)
+
+        # Field values resolved for {FIELD} substitution, keyed by (document, field name)
+        self._fieldCache = {}
+        self._fieldCacheTtl = fieldCacheTtl if fieldCacheTtl is not None else self.FIELD_CACHE_TTL
+        self._fieldCacheMarker = fieldCacheMarker
+        # Without a TTL or marker, values are reused only within one log()/email() call (see _beginFieldEvent)
+        self._fieldCachePersistent = self._fieldCacheTtl is not None or fieldCacheMarker is not None
+        self._fieldEventLocal = threading.local()
+        self._templateCache = self._getProcessCache('templates')
+        self._fieldCacheHits = 0
+        self._fieldCacheMisses = 0
+
+        # Resolved by _getLabel() on first emit, so instances that never log skip the document lookups
+        self._labelTemplate = label
+        self._labelResolved = False
+        self._label = None
+
+        if self._sinkBuffers(self._sink) or self._mailPool is not None:
+            # Buffered records and queued mail failures are written at process exit if the script never flushes
+            self._registerExitReport()
+
+    def _getLabel(self):
+        """The instance label with form/application defaults and {FIELD} values resolved (once)."""
+        if not self._labelResolved:
+            label = self._labelTemplate
+            if not label:
+                if self._document is not None:
+                    formName = self._document.getFormName()
+                    applicationName = self._document.getParentApplication().getName()
+                    label = '{} - {} #{}'.format(applicationName, formName, '{ETQ$NUMBER}')
+            self._label = self._getFieldsInString(label)
+            self._labelResolved = True
+        return self._label
+
+    @classmethod
+    def forDocument(cls, document=None, **kwargs):
+        """
+        Return a shared instance for this document and constructor arguments, creating it on first use.
+        Instances are kept per class, so they never outlive the script run that defined the class.
+        Unhashable arguments (e.g. a sink) bypass the cache and build a new instance.
+        """
+        document = thisDocument if document is None else document
+        key = (cls, id(document), tuple(sorted(kwargs.items())))
+        try:
+            entry = cls._instances.get(key)
+        except TypeError:
+            return cls(document=document, **kwargs)
+        if entry is not None and entry[0] is document:
+            return entry[1]
+
+        instance = cls(document=document, **kwargs)
+        if len(cls._instances) >= cls.INSTANCE_CACHE_SIZE:
+            cls._instances.clear()
+        cls._instances[key] = (document, instance)
+        return instance
+
+    @classmethod
+    def _isProduction(cls):
+        """True in the production environment; cached process-wide for ENVIRONMENT_CACHE_TTL seconds."""
+        cache = cls._getProcessCache('environment')
+        entry = cache.get('isProd')
+        now = time.time()
+        if entry is None or now >= entry[1]:
+            env = engineConfig.getEnvironmentName()
+            entry = cache['isProd'] = (env.lower() in ['production', 'prod'], now + cls.ENVIRONMENT_CACHE_TTL)
+        return entry[0]
+
+    @classmethod
+    def _isAdministrator(cls):
+        """True if thisUser is in ADMINISTRATORS; cached per user ID for ROLE_CACHE_TTL seconds."""
+        try:
+            userId = thisUser.getID()
+        except Exception:
+            return thisUser.isMember('ADMINISTRATORS', None)
+
+        cache = cls._getProcessCache('roles')
+        entry = cache.get(userId)
+        now = time.time()
+        if entry is None or now >= entry[1]:
+            entry = cache[userId] = (bool(thisUser.isMember('ADMINISTRATORS', None)), now + cls.ROLE_CACHE_TTL)
+        return entry[0]
+
+    @classmethod
+    def invalidateEnvironmentCache(cls, userId=None):
+        """
+        Drop cached environment/role decisions so the next instance looks them up again.
+        userId: only forget that user's ADMINISTRATORS decision (e.g. after a group change)
+        """
+        roles = cls._getProcessCache('roles')
+        if userId is not None:
+            roles.pop(userId, None)
+            return
+        roles.clear()
+        cls._getProcessCache('environment').clear()
     
     def setMinLevel(self, level):
-        """Set the minimum logging level."""
-        self._minLevel = self._normalizeLevel(level)
+        """Set the minimum logging level (stored as its integer index)."""
+        self._minLevel = self._getLevelIndex(level)
 
     def _normalizeLevel(self, level):
         """Convert 'information' → 'info', return canonical level"""
-        level = level.lower()
-        for canonical, info in self.LEVEL_MAP.items():
-            if level in info['aliases']:
-                return canonical
-        return 'debug'  # default
+        return self.LEVEL_ORDER[self._getLevelIndex(level)]
     
     def _getLevelIndex(self, level):
-        """Get numeric index for level comparison."""
-        canonical = self._normalizeLevel(level)
-        try:
-            return self.LEVEL_ORDER.index(canonical)
-        except ValueError:
-            return 0  # default to debug
+        """Get numeric index for level comparison (unknown levels default to debug)."""
+        if isinstance(level, int):
+            return level
+        index = self.LEVEL_INDEX.get(level)
+        if index is None:
+            index = self.LEVEL_INDEX.get(level.lower(), 0)
+        return index
         
     def _shouldLog(self, level, enabled=None):
         """
@@ -60,14 +1058,32 @@ class EtqDebug(object):
         """
         if enabled is not None:
             # If enabled is explicitly set, log if it's True or if level is 'error'
-            return enabled or self._getLevelIndex(level) >= self._getLevelIndex('error')
+            return enabled or self._getLevelIndex(level) >= self._errorIndex
 
-        if self._minLevel == 'none':
-            return False  # Special case: nothing logs
-        
-        callerIdx = self._getLevelIndex(level)
-        minIdx = self._getLevelIndex(self._minLevel)
-        return callerIdx >= minIdx
+        # minLevel 'none' is the highest index, so nothing passes it
+        return self._minLevel < self._noneIndex and self._getLevelIndex(level) >= self._minLevel
+
+    def isEnabledFor(self, level):
+        """
+        Return True if a message at this level would be emitted.
+        Use it to guard expensive message building:
+            if debug.isEnabledFor('debug'):
+                debug.log(buildBigDict(), multiple=True)
+        """
+        return self._shouldLog(level)
+
+    def _resolveMessage(self, msg, args=None):
+        """
+        Build a lazy message once it is known to be emitted.
+        - args: '%' formatting arguments applied to msg (tuple, dict or single value)
+        - msg as any callable (function, lambda, functools.partial, bound method): called with no arguments;
+          classes are logged as they are
+        """
+        if args is not None:
+            return msg % args
+        if callable(msg) and not isinstance(msg, (type, types.ClassType)):
+            return msg()
+        return msg
 
     def _toUnicode(self, value, encoding='utf-8'):
         """Enhanced unicode conversion with better error handling"""
@@ -117,6 +1133,130 @@ class EtqDebug(object):
 
         return output
 
+    def _getCachedField(self, fieldName, document=None):
+        """
+        Return the substitution value for a field, resolving it through _getField only on a cache miss.
+        By default values live for one log()/email() call; with fieldCacheTtl or fieldCacheMarker they
+        are kept across calls and expire after the TTL or when fieldCacheMarker(document) changes.
+        """
+        document = document if document != None else self._document
+        if self._fieldCachePersistent:
+            cache = self._fieldCache
+        else:
+            cache = getattr(self._fieldEventLocal, 'cache', None)
+            if cache is None:
+                # Outside a log()/email() call there is no event to scope the value to
+                return self._getField(fieldName, document)
+        key = (id(document), fieldName)
+        marker = self._fieldCacheMarker(document) if self._fieldCacheMarker is not None else None
+        now = time.time() if self._fieldCacheTtl is not None else None
+
+        entry = cache.get(key)
+        if entry is not None:
+            value, cachedDocument, cachedMarker, cachedAt = entry
+            if cachedDocument is document and cachedMarker == marker and (now is None or now - cachedAt < self._fieldCacheTtl):
+                self._fieldCacheHits += 1
+                if self._metrics is not None:
+                    self._metrics.cacheLookup('field', True)
+                return value
+
+        self._fieldCacheMisses += 1
+        if self._metrics is not None:
+            self._metrics.cacheLookup('field', False)
+        value = self._getField(fieldName, document)
+        cache[key] = (value, document, marker, now)
+        return value
+
+    def _beginFieldEvent(self):
+        """
+        Open the per-call field cache for this thread, unless values persist across calls or an
+        outer log()/email() call already opened it. Returns True if the caller must close it.
+        """
+        if self._fieldCachePersistent or getattr(self._fieldEventLocal, 'cache', None) is not None:
+            return False
+        self._fieldEventLocal.cache = {}
+        return True
+
+    def clearFieldCache(self, document=None, fieldName=None):
+        """
+        Invalidate cached field values.
+        - No arguments: clear everything
+        - document: only entries for that document
+        - fieldName: only entries for that field (optionally limited to document)
+        """
+        if document is None and fieldName is None:
+            self._fieldCache.clear()
+            return
+        for key in list(self._fieldCache.keys()):
+            if document is not None and key[0] != id(document):
+                continue
+            if fieldName is not None and key[1] != fieldName:
+                continue
+            del self._fieldCache[key]
+
+    def fieldCacheStats(self):
+        """Return hit/miss counters for the field value cache."""
+        lookups = self._fieldCacheHits + self._fieldCacheMisses
+        return {
+            'hits': self._fieldCacheHits,
+            'misses': self._fieldCacheMisses,
+            'size': len(self._fieldCache),
+            'hitRate': float(self._fieldCacheHits) / lookups if lookups else 0.0
+        }
+
+    def _compileTemplate(self, inputString):
+        """
+        Tokenize a format string once into literal and field segments.
+        Literals are unicode strings, fields are 1-tuples (fieldName,).
+        Returns an empty tuple when the string has no field placeholders.
+        Compiled templates are cached by string.
+        """
+        template = self._templateCache.get(inputString)
+        if self._metrics is not None:
+            self._metrics.cacheLookup('template', template is not None)
+        if template is not None:
+            return template
+
+        segments = []
+        literalStart = 0
+        pos = 0
+        while True:
+            openPos = inputString.find('{', pos)
+            if openPos < 0:
+                break
+            closePos = inputString.find('}', openPos + 1)
+            if closePos < 0:
+                break
+            nestedPos = inputString.find('{', openPos + 1, closePos)
+            if nestedPos >= 0:
+                # '{{NAME}' - the inner brace starts the placeholder
+                pos = nestedPos
+                continue
+            fieldName = inputString[openPos + 1:closePos]
+            pos = closePos + 1
+            if ':' in fieldName or ',' in fieldName or fieldName == '':
+                # Not a fieldname, likely a dict
+                continue
+            segments.append(self._toUnicode(inputString[literalStart:openPos]))
+            segments.append((fieldName,))
+            literalStart = pos
+
+        if segments:
+            segments.append(self._toUnicode(inputString[literalStart:]))
+        template = tuple(segments)
+
+        if len(self._templateCache) >= self.TEMPLATE_CACHE_SIZE:
+            self._templateCache.clear()
+        self._templateCache[inputString] = template
+        return template
+
+    def _renderTemplate(self, template, document):
+        """Render a compiled template in a single join."""
+        return u''.join([
+            self._toUnicode(self._getCachedField(segment[0], document)) if isinstance(segment, tuple) else segment
+            for segment in template
+        ])
+
     def _getFieldsInString(self, inputString, document = None):
         document = document if document != None else self._document
         if document is None:
@@ -127,84 +1267,580 @@ class EtqDebug(object):
             # Input is not a string, return the original input
             return inputString
         
-        if '{' and '}' in inputString:
-            # Inline fields detected
-            fieldNames = [i.split('}')[0] for i in inputString.split('{')[1:]]
-            for fieldName in fieldNames:
-                if ':' in fieldName or ',' in fieldName or fieldName == '':
-                    # Not a fieldname, likely a dict
-                    continue
-                inputString = self._toUnicode(inputString).replace('{'+fieldName+'}', self._getField(fieldName, document) )
-        return(inputString)
+        if '{' not in inputString or '}' not in inputString:
+            return inputString
 
-    def _getCallerInfo(self, depth=3, delimiter='\n', className=None):
+        template = self._compileTemplate(inputString)
+        if not template:
+            return inputString
+        if self._metrics is None:
+            return self._renderTemplate(template, document)
+        start = time.time()
+        output = self._renderTemplate(template, document)
+        self._metrics.addSeconds('substitute', time.time() - start)
+        return output
+
+    def _getCaller(self, depth=2, className=None):
         """
-        Retrieves caller information using inspect module.
+        Return 'func() line=N' for the frame `depth` levels above this method ('' at module level).
+        Walks only the frames needed; the result is cached per code object and line.
         """
-        stack = traceback.extract_stack()
-        if len(stack) <= depth + 1:
+        try:
+            frame = sys._getframe(depth)
+        except ValueError:
             return ''
-        
-        frame = stack[-depth - 1]  # 3 levels up
+        return self._formatCaller(frame.f_code, frame.f_lineno, className)
 
+    def _formatCaller(self, code, lineno, className=None):
+        """'func() line=N' for a code object and line, cached per (code, line, className)."""
         if not className and hasattr(self, 'className'):
             className = self.className
-        
-        lineNumber = frame[1]
-        funcName = frame[2] or ''
-
-        if funcName == '<module>':
-            return ''
-        
-        if className:
-            funcName = '{}.{}'.format(className, funcName)
-
-        output = '{}{}() line={}:'.format(delimiter, funcName, lineNumber)
 
+        key = (code, lineno, className)
+        output = self._callerCache.get(key)
+        if self._metrics is not None:
+            self._metrics.cacheLookup('caller', output is not None)
+        if output is None:
+            funcName = code.co_name or ''
+            if funcName == '<module>':
+                output = ''
+            else:
+                if className:
+                    funcName = '{}.{}'.format(className, funcName)
+                output = '{}() line={}'.format(funcName, lineno)
+            if len(self._callerCache) >= self.CALLER_CACHE_SIZE:
+                self._callerCache.clear()
+            self._callerCache[key] = output
         return output
+
+    def _getCallerInfo(self, depth=3, delimiter='\n', className=None):
+        """
+        Retrieves caller information as '<delimiter>func() line=N:'.
+        depth counts frames above this method (3 = the code that called log/email).
+        """
+        caller = self._getCaller(depth + 1, className=className)
+        return '{}{}:'.format(delimiter, caller) if caller else ''
     
-    def _getMessageHeader(self, level, showCaller=True, delimiter='\n', className=None):
+    def _getMessageHeader(self, level, showCaller=True, delimiter='\n', className=None, callerDepth=0):
         levelAlias = self.LEVEL_MAP[level]['display']
-        header = '{}[{}] {}'.format(delimiter, levelAlias, self._label)     
+        header = '{}[{}] {}'.format(delimiter, levelAlias, self._getLabel())     
         if showCaller:
-            header += self._getCallerInfo(delimiter=delimiter, className=className)
+            header += self._getCallerInfo(depth=3 + callerDepth, delimiter=delimiter, className=className)
         return header
 
-    def _formatMessage(self, msg, label, messageList, multiple=False, delimiter='\n', indent='    ', multipleShowIndex=True):
+    def _formatMessage(self, msg, label, messageList, multiple=False, delimiter='\n', indent='    ', multipleShowIndex=True, maxDepth=None, maxItems=None, maxBytes=None):
         """
         Formats a message and label and appends it to the message list.
         If msg is a string, it combines the label and message.
         Otherwise, it appends the label (if any) and the message separately.
+        With multiple=True the structure is expanded by _iterFormatLines and joined with delimiter.
         """        
         if multiple:
-            # Treat iterable elements as separate messages using new lines
-            multipleList = []
-            try:
-                if isinstance(msg, dict):
-                    for key, value in msg.items():
-                        self._formatMessage(value, key, multipleList)
-                else:
-                    for index, value in enumerate(msg):
-                        self._formatMessage(value, str(index) if multipleShowIndex else '', multipleList)
-            except Exception as e:
-                messageList.append('Format error: {}'.format(str(e)))
-
-            if multipleList:
-                msg = delimiter + indent + (delimiter + indent).join(multipleList)
+            lines = self._iterFormatLines(msg, label, indent=indent, multipleShowIndex=multipleShowIndex, maxDepth=maxDepth, maxItems=maxItems, maxBytes=maxBytes)
+            messageList.append(delimiter.join(lines))
+            return
                 
         if label is None:
             label = 'msg'
         messageList.append(indent+'{}{}'.format('{}: '.format(label) if label else '', msg))
 
-    def log(self, msg, label=None, multiple = False, enabled=None, document=None, level='debug', showCaller=True, multipleShowIndex=True, className=None):    
-        if self._shouldLog(level, enabled=enabled):
-            output = []
-            header = self._getMessageHeader(level=level, showCaller=showCaller, className=className)
+    def _formatValue(self, value, budget=None):
+        """
+        Inline text for a value that is not expanded, at most `budget` characters (FORMAT_MAX_VALUE_BYTES)
+        plus a '...' marker. Containers are rendered like their repr: levels past FORMAT_INLINE_DEPTH
+        print as '[...]' (which also caps the recursion), and rendering stops once the budget is used up.
+        Errors from str()/repr() are shown in place of the value.
+        """
+        budget = budget or self.FORMAT_MAX_VALUE_BYTES
+        containerTypes = (dict, list, tuple, set, frozenset)
+        text = None
+        if isinstance(value, basestring):
+            text = value
+        elif not isinstance(value, containerTypes):
+            try:
+                text = '{}'.format(value)
+            except Exception as e:
+                return '<format error: {}>'.format(e)
+        elif len(value) <= 8:
+            # Small flat containers (the common case) go straight to repr
+            for item in (value.values() if isinstance(value, dict) else value):
+                if isinstance(item, containerTypes) or (isinstance(item, basestring) and len(item) > budget):
+                    break
+            else:
+                try:
+                    text = repr(value)
+                except Exception:
+                    pass
+        if text is not None:
+            return text if len(text) <= budget else text[:budget] + '...'
 
-            self._formatMessage(msg, label, output, multiple=multiple, multipleShowIndex=multipleShowIndex)
+        parts = []
+        used = [0]
 
-            for line in output:
-                Rutilities.debug(self._getFieldsInString(header + '\n' + line, document=document))
+        def add(text):
+            parts.append(text)
+            used[0] += len(text)
+
+        def leaf(item):
+            if isinstance(item, basestring) and len(item) > budget:
+                item = item[:budget]
+            try:
+                return repr(item)
+            except Exception as e:
+                return '<repr error: {}>'.format(e)
+
+        def render(container, depth, path):
+            opening, closing = [(o, c) for t, o, c in self._INLINE_BRACKETS if isinstance(container, t)][0]
+            if id(container) in path:
+                return add('<cycle>')
+            if depth >= self.FORMAT_INLINE_DEPTH:
+                return add(opening + '...' + closing)
+            path.add(id(container))
+            add(opening)
+            isDict = isinstance(container, dict)
+            count = 0
+            try:
+                for item in (container.items() if isDict else container):
+                    if used[0] >= budget:
+                        break
+                    add(', ' if count else '')
+                    count += 1
+                    if isDict:
+                        key, item = item
+                        add(leaf(key) + ': ')
+                    if isinstance(item, containerTypes) and len(item):
+                        render(item, depth + 1, path)
+                    else:
+                        add(leaf(item))
+            except Exception as e:
+                add('<format error: {}>'.format(e))
+            add(',' + closing if isinstance(container, tuple) and count == 1 else closing)
+            path.discard(id(container))
+
+        render(value, 0, set())
+        text = ''.join(parts)
+        return text if len(text) <= budget else text[:budget] + '...'
+
+    def _iterFormatLines(self, msg, label, indent='    ', multipleShowIndex=True, maxDepth=None, maxItems=None, maxBytes=None):
+        """
+        Iteratively expand msg (dict, list, tuple, set or any iterable at the top level) into
+        indented "key: value" lines, one generator step per line, without recursion.
+        - maxDepth: container levels to expand (FORMAT_MAX_DEPTH); deeper containers print inline
+        - maxItems: items shown per container before a "... N more" marker (FORMAT_MAX_ITEMS, 0 = no limit)
+        - maxBytes: total characters before the output is cut off (FORMAT_MAX_BYTES, 0 = no limit)
+        Values that are not expanded are rendered inline by _formatValue within the remaining bytes.
+        Containers already being expanded higher up the path print as <cycle>; an item that fails
+        to format prints a "Format error" line instead of aborting log().
+        """
+        maxDepth = self.FORMAT_MAX_DEPTH if maxDepth is None else maxDepth
+        maxItems = self.FORMAT_MAX_ITEMS if maxItems is None else maxItems
+        maxBytes = self.FORMAT_MAX_BYTES if maxBytes is None else maxBytes
+        valueBytes = self.FORMAT_MAX_VALUE_BYTES
+
+        def prefix(key):
+            if key is None:
+                key = 'msg'
+            return '{}: '.format(key) if key else ''
+
+        def items(container):
+            if isinstance(container, dict):
+                return iter(container.items())
+            if multipleShowIndex:
+                return ((str(index), value) for index, value in enumerate(container))
+            return (('', value) for value in container)
+
+        def isEmpty(container):
+            try:
+                return len(container) == 0
+            except TypeError:
+                return False
+
+        try:
+            rootItems = items(msg) if maxDepth >= 1 and not isinstance(msg, basestring) and not isEmpty(msg) else None
+        except TypeError:
+            rootItems = None  # not iterable
+        if rootItems is None:
+            try:
+                line = indent + prefix(label)
+                yield line + self._formatValue(msg, min(self.FORMAT_MAX_VALUE_BYTES, maxBytes or self.FORMAT_MAX_VALUE_BYTES))
+            except Exception as e:
+                yield indent + 'Format error: {}'.format(str(e))
+            return
+
+        line = indent + prefix(label)
+        used = len(line)
+        yield line
+
+        # Each frame: [item iterator, depth, container id, items shown, container]
+        stack = [[rootItems, 1, id(msg), 0, msg]]
+        path = set([id(msg)])
+        while stack:
+            frame = stack[-1]
+            iterator, depth, containerId, shown, container = frame
+            try:
+                key, value = next(iterator)
+            except StopIteration:
+                stack.pop()
+                path.discard(containerId)
+                continue
+            except Exception as e:
+                yield indent * (depth + 1) + 'Format error: {}'.format(str(e))
+                stack.pop()
+                path.discard(containerId)
+                continue
+
+            if maxItems and shown >= maxItems:
+                try:
+                    more = '{} more'.format(len(container) - shown)
+                except TypeError:
+                    more = 'more'
+                yield indent * (depth + 1) + '... {}'.format(more)
+                stack.pop()
+                path.discard(containerId)
+                continue
+            frame[3] += 1
+
+            try:
+                line = indent * (depth + 1) + prefix(key)
+                expand = depth < maxDepth and isinstance(value, (dict, list, tuple, set, frozenset)) and not isEmpty(value)
+                if expand and id(value) in path:
+                    line += '<cycle>'
+                    expand = False
+                elif expand:
+                    pass
+                elif isinstance(value, basestring) and len(value) <= valueBytes:
+                    # Plain strings (the common leaf) are used as is
+                    line += value
+                else:
+                    budget = valueBytes
+                    if maxBytes:
+                        budget = max(1, min(budget, maxBytes - used - len(line)))
+                    line += self._formatValue(value, budget)
+            except Exception as e:
+                line = indent * (depth + 1) + 'Format error: {}'.format(str(e))
+                expand = False
+
+            if maxBytes and used + len(line) > maxBytes:
+                yield indent + '... output truncated at {} bytes'.format(maxBytes)
+                return
+            used += len(line) + 1
+            yield line
+
+            if expand:
+                stack.append([items(value), depth + 1, id(value), 0, value])
+                path.add(id(value))
+
+    def _iterBlocks(self, lines, blockBytes=None):
+        """Group formatted lines into newline-joined blocks of roughly blockBytes characters."""
+        blockBytes = blockBytes or self.FORMAT_BLOCK_BYTES
+        block = []
+        size = 0
+        for line in lines:
+            block.append(line)
+            size += len(line) + 1
+            if size >= blockBytes:
+                yield '\n'.join(block)
+                block = []
+                size = 0
+        if block:
+            yield '\n'.join(block)
+
+    def log(self, msg, label=None, multiple = False, enabled=None, document=None, level='debug', showCaller=True, multipleShowIndex=True, className=None, callerDepth=0, args=None, every=None, perSecond=None, collapse=False, maxDepth=None, maxItems=None, maxBytes=None):    
+        metrics = self._metrics
+        if not self._shouldLog(level, enabled=enabled):
+            if metrics is not None and metrics.countCall(self._getLevelIndex(level), self._getSite(1 + callerDepth), metrics.FILTERED):
+                self.reportMetrics()
+            if self._flightSize and enabled is None:
+                # Flight recorder: keep the raw call; formatting, fields and caller name wait for a dump
+                frame = sys._getframe(1 + callerDepth) if showCaller else None
+                self._getFlightBuffer().append((time.time(), self._getLevelIndex(level), frame and frame.f_code, frame and frame.f_lineno, className, msg, args, label, multiple, multipleShowIndex, document))
+            return
+
+        if self._flightSize and self._getLevelIndex(level) >= self._errorIndex:
+            self.dumpFlightRecorder()
+
+        note = None
+        if every or perSecond or collapse:
+            # Throttled call site: decide before any formatting or field substitution
+            note = self._throttle(sys._getframe(1 + callerDepth), msg, args, label, every, perSecond, collapse, level)
+            if note is False:
+                if metrics is not None and metrics.countCall(self._getLevelIndex(level), self._getSite(1 + callerDepth), metrics.THROTTLED):
+                    self.reportMetrics()
+                return
+
+        openedEvent = self._beginFieldEvent()
+        try:
+            if metrics is not None:
+                site = self._getSite(1 + callerDepth)
+                due = metrics.countCall(self._getLevelIndex(level), site, metrics.EMITTED)
+                start = time.time()
+
+            msg = self._resolveMessage(msg, args)
+            caller = self._getCaller(2 + callerDepth, className=className) if showCaller else ''
+            message = self._buildMessage(msg, label, multiple, document, note, multipleShowIndex, maxDepth, maxItems, maxBytes)
+
+            # The label is resolved once per record, not once per output line
+            record = EtqDebugRecord(time.time(), self._getLevelIndex(level), self._getFieldsInString(self._getLabel(), document=document), caller, message, self._getDocumentId(document))
+            if metrics is None:
+                self._sink.emit(record)
+                return
+
+            if isinstance(message, list):
+                metrics.addChars('message', sum(len(line) for line in message), site)
+            else:
+                record.message = self._meteredBlocks(message, site)
+            metrics.addSeconds('format', time.time() - start)
+            formatBefore = metrics.seconds['format']
+            start = time.time()
+            self._sink.emit(record)
+            # Streamed multiple=True blocks are formatted while the sink consumes them
+            metrics.addSeconds('send', time.time() - start - (metrics.seconds['format'] - formatBefore))
+            if due:
+                self.reportMetrics()
+        finally:
+            if openedEvent:
+                self._fieldEventLocal.cache = None
+
+    def _meteredBlocks(self, blocks, site):
+        """Pass streamed message blocks through, crediting their formatting time and size to the metrics."""
+        metrics = self._metrics
+        blocks = iter(blocks)
+        while True:
+            start = time.time()
+            try:
+                block = next(blocks)
+            except StopIteration:
+                metrics.addSeconds('format', time.time() - start)
+                return
+            metrics.addSeconds('format', time.time() - start)
+            metrics.addChars('message', len(block), site)
+            yield block
+
+    def _buildMessage(self, msg, label, multiple, document, note=None, multipleShowIndex=True, maxDepth=None, maxItems=None, maxBytes=None):
+        """Formatted, field-resolved message lines for a record (a block generator when multiple=True)."""
+        if multiple:
+            # Stream the expanded structure to the sink in bounded blocks instead of one big string
+            lines = self._iterFormatLines(msg, label, multipleShowIndex=multipleShowIndex, maxDepth=maxDepth, maxItems=maxItems, maxBytes=maxBytes)
+            if note:
+                lines = itertools.chain(lines, ['    ' + note])
+            return (self._getFieldsInString(block, document=document) for block in self._iterBlocks(lines))
+
+        output = []
+        self._formatMessage(msg, label, output)
+        if note and output:
+            output[-1] += ' ' + note
+        return [self._getFieldsInString(line, document=document) for line in output]
+
+    def setFlightRecorder(self, size):
+        """
+        Keep the last `size` log() calls that were filtered out by minLevel, per thread, in a ring buffer.
+        They are stored unformatted and only rendered when an error is logged or an exception
+        escapes a `with debug:` block. None or 0 turns the recorder off (and drops this thread's buffer).
+        """
+        self._flightSize = size or 0
+        self._flightLocal.__dict__.pop('buffer', None)
+
+    def _getFlightBuffer(self):
+        buffer = getattr(self._flightLocal, 'buffer', None)
+        if buffer is None or buffer.maxlen != self._flightSize:
+            buffer = self._flightLocal.buffer = collections.deque(buffer or (), self._flightSize)
+        return buffer
+
+    def dumpFlightRecorder(self, reason='error'):
+        """
+        Render this thread's flight-recorder records to the sink (oldest first) and clear the buffer.
+        Messages are formatted now, so lazy messages and args reflect their current values.
+        Returns the number of records written.
+        """
+        buffer = getattr(self._flightLocal, 'buffer', None)
+        if not buffer:
+            return 0
+        records = list(buffer)
+        buffer.clear()
+
+        label = self._getLabel()
+        self._sink.emit(EtqDebugRecord(time.time(), self._errorIndex, label, '', [u'    flight recorder: last {} record(s) before {}'.format(len(records), reason)], self._getDocumentId()))
+        for timestamp, levelIndex, code, lineno, className, msg, args, msgLabel, multiple, multipleShowIndex, document in records:
+            try:
+                msg = self._resolveMessage(msg, args)
+            except Exception as e:
+                msg = u'<message failed: {}>'.format(e)
+            caller = self._formatCaller(code, lineno, className) if code is not None else ''
+            message = self._buildMessage(msg, msgLabel, multiple, document, multipleShowIndex=multipleShowIndex)
+            self._sink.emit(EtqDebugRecord(timestamp, levelIndex, self._getFieldsInString(self._getLabel(), document=document), caller, message, self._getDocumentId(document)))
+        return len(records)
+
+    def _getDocumentId(self, document=None):
+        """ID of the document used for field substitution (None if unavailable)."""
+        document = document if document is not None else self._document
+        if document is None:
+            return None
+        # Entries hold the document so a recycled id() never returns another document's ID
+        key = id(document)
+        entry = self._documentIds.get(key)
+        if entry is None or entry[0] is not document:
+            try:
+                documentId = document.getID()
+            except Exception:
+                documentId = None
+            if len(self._documentIds) >= self.DOCUMENT_ID_CACHE_SIZE:
+                self._documentIds.clear()
+            entry = self._documentIds[key] = (document, documentId)
+        return entry[1]
+
+    def _throttle(self, frame, msg, args, label, every, perSecond, collapse, level):
+        """
+        Per-call-site throttle for log(), keyed by the caller's code object and line.
+        Returns False to suppress the call, otherwise None or a note about suppressed calls.
+        - every: emit the 1st, (N+1)th, (2N+1)th... call
+        - perSecond: token bucket allowing at most this many calls per second (bursts up to the same number)
+        - collapse: drop consecutive identical messages; the count is logged as "repeated Nx"
+          when this site logs a different message, on flush()/flushThrottled(), or at process exit
+        """
+        site = (frame.f_code, frame.f_lineno)
+        state = self._throttleState.get(site)
+        if state is None:
+            state = self._throttleState[site] = {'calls': 0, 'suppressed': 0, 'tokens': float(perSecond or 0), 'updated': time.time(), 'last': None, 'repeats': 0, 'label': label, 'level': level}
+        state['calls'] += 1
+
+        if collapse:
+            current = (msg, args, label)
+            if state['last'] is not None and state['last'] == current:
+                state['repeats'] += 1
+                if state['repeats'] == 1:
+                    self._pendingRepeats[site] = state
+                    if not self._exitReportRegistered:
+                        self._registerExitReport()
+                return False
+            self._emitRepeats(site, state)
+            state['last'] = current
+            state['label'] = label
+            state['level'] = level
+
+        if every and (state['calls'] - 1) % every != 0:
+            state['suppressed'] += 1
+            return False
+
+        if perSecond:
+            now = time.time()
+            state['tokens'] = min(float(perSecond), state['tokens'] + (now - state['updated']) * perSecond)
+            state['updated'] = now
+            if state['tokens'] < 1:
+                state['suppressed'] += 1
+                return False
+            state['tokens'] -= 1
+
+        if state['suppressed']:
+            suppressed, state['suppressed'] = state['suppressed'], 0
+            return '({} similar message(s) suppressed at this call site)'.format(suppressed)
+        return None
+
+    def _emitRepeats(self, site, state):
+        """Log the pending "repeated Nx" line for a collapsed call site."""
+        self._pendingRepeats.pop(site, None)
+        if state['repeats']:
+            repeats, state['repeats'] = state['repeats'], 0
+            code, lineNumber = site
+            self.log('previous message repeated {}x'.format(repeats), '{}() line={} {}'.format(code.co_name, lineNumber, state['label'] or 'msg'), level=state['level'], enabled=True, showCaller=False)
+
+    def flushThrottled(self):
+        """Log any pending "repeated Nx" lines from collapsed call sites."""
+        for site, state in list(self._pendingRepeats.items()):
+            self._emitRepeats(site, state)
+
+    def setSink(self, sink):
+        """Replace the log sink (or list of sinks), flushing anything the current one still holds."""
+        self._sink.flush()
+        self._sink = self._makeSink(sink)
+        if self._sinkBuffers(self._sink):
+            self._registerExitReport()
+
+    @staticmethod
+    def _sinkBuffers(sink):
+        """True if the sink holds records until flush() (they must be flushed at exit too)."""
+        if isinstance(sink, EtqDebugMultiSink):
+            return any(EtqDebug._sinkBuffers(child) for child in sink.sinks)
+        return isinstance(sink, (EtqDebugBufferedSink, EtqDebugJsonLinesSink))
+
+    def _makeSink(self, sink):
+        if sink is None:
+            sink = EtqDebugSink()
+        elif isinstance(sink, (list, tuple)):
+            sink = EtqDebugMultiSink(sink)
+        self._attachMetrics(sink)
+        return sink
+
+    def _attachMetrics(self, sink):
+        """Point a sink (and the sinks inside a multi-sink) at this instance's metrics."""
+        for inner in getattr(sink, 'sinks', ()):
+            self._attachMetrics(inner)
+        if hasattr(sink, 'metrics'):
+            sink.metrics = self._metrics
+
+    def setMetrics(self, metrics):
+        """Turn self-metrics on (True or an EtqDebugMetrics to share) or off (None)."""
+        self._metrics = EtqDebugMetrics() if metrics is True else metrics
+        self._attachMetrics(self._sink)
+
+    def metricsStats(self, top=None):
+        """Current self-metrics as a dict (see EtqDebugMetrics.stats), or None when metrics are off."""
+        return self._metrics.stats(top) if self._metrics is not None else None
+
+    def reportMetrics(self, reset=False, level='info'):
+        """
+        Write the self-metrics as one summary record (always emitted, whatever minLevel is)
+        and schedule the next periodic one. Returns the stats dict.
+        """
+        metrics = self._metrics
+        if metrics is None:
+            return None
+        if metrics.interval:
+            metrics.nextDump = time.time() + metrics.interval
+        stats = metrics.stats()
+        summary = collections.OrderedDict([
+            ('levels', stats['levels']),
+            ('chars', stats['chars']),
+            ('seconds', dict((kind, round(seconds, 4)) for kind, seconds in stats['seconds'].items())),
+            ('caches', dict((name, '{hits}/{misses} ({hitRate:.1%})'.format(**counts)) for name, counts in stats['caches'].items())),
+            ('sites', ['{site}: {calls} calls ({emitted} emitted, {filtered} filtered, {throttled} throttled), {chars} chars'.format(**site) for site in stats['sites']])
+        ])
+        self.log(summary, 'EtqDebug metrics ({:.0f} s)'.format(stats['elapsed']), multiple=True, level=level, enabled=True, showCaller=False, maxDepth=2, multipleShowIndex=False)
+        if reset:
+            metrics.reset()
+        return stats
+
+    def _getSite(self, depth):
+        """(code object, line) of the frame `depth` levels above the caller, or None."""
+        try:
+            frame = sys._getframe(depth + 1)
+        except ValueError:
+            return None
+        return frame.f_code, frame.f_lineno
+
+    def flush(self):
+        """
+        Log accumulated profiles, write out anything buffered by the sink and send any queued email digest.
+        Mail pool workers exit once their queue is sent instead of staying parked after the script.
+        """
+        self.flushThrottled()
+        self.reportProfiles()
+        self.reportSpans()
+        if self._metrics is not None and self._metrics.dumpOnFlush:
+            self.reportMetrics()
+        self._flushEmailDigest(force=True)
+        if self._mailPool is not None:
+            self._mailPool.shutdown(wait=False)
+        self._reportMailFailures()
+        self._sink.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, tb):
+        if excType is not None and self._flightSize:
+            self.dumpFlightRecorder(reason=u'{}: {}'.format(excType.__name__, self._toUnicode(excValue)))
+        self.flush()
+        return False
     
     def alert(self, msg, label=None, multiple = False, document=None, level='debug', enabled=False):
         if self._shouldLog(level, enabled=enabled):
@@ -214,7 +1850,7 @@ class EtqDebug(object):
             for line in output:
                 document.addWarning(line)  
 
-    def email(self, msg, label=None, subject=None, toEmails=None, toUserIds=None, toGroup='DEVELOPERS', copyToEmails=None, copyUserIds=None, multiple=False, document=None, level='debug', enabled=False, includeCaller=True, sendFailureNotification=True, priority=None, multipleShowIndex=True, className=None):
+    def email(self, msg, label=None, subject=None, toEmails=None, toUserIds=None, toGroup='DEVELOPERS', copyToEmails=None, copyUserIds=None, multiple=False, document=None, level='debug', enabled=False, includeCaller=True, sendFailureNotification=True, priority=None, multipleShowIndex=True, className=None, callerDepth=0, args=None, attachments=None):
         """
         Send a debug email using PublicMail / PublicMailSender.
 
@@ -242,55 +1878,113 @@ class EtqDebug(object):
             - If true, request delivery-failure email on errors
         priority:
             - Optional PublicMailSender.HIGHPRIORITY / NORMALPRIORITY / LOWPRIORITY
+        callerDepth:
+            - Extra frames to skip when resolving the caller (e.g. 1 from inside a logging helper)
+        args:
+            - Optional '%' formatting arguments for msg, applied only if the email is sent
+        attachments:
+            - Optional list of PublicAttachment objects (mails with attachments bypass the digest)
         """
         # respect logging level unless explicitly enabled
         if not self._shouldLog(level, enabled=enabled):
             return
 
-        document = document if document is not None else self._document
+        # {FIELD} values resolved for the header, body and subject are shared for this call
+        openedEvent = self._beginFieldEvent()
+        try:
+            msg = self._resolveMessage(msg, args)
+
+            document = document if document is not None else self._document
+
+            # ----- build header / message lines (reuse existing behavior) -----
+            header = self._getMessageHeader(level=self._normalizeLevel(level), showCaller=includeCaller, delimiter='<br>', className=className, callerDepth=callerDepth)
 
-        # ----- build header / message lines (reuse existing behavior) -----
-        header = self._getMessageHeader(level=self._normalizeLevel(level), showCaller=includeCaller, delimiter='<br>', className=className)
+            messageLines = []
+            self._formatMessage(msg, label, messageList=messageLines, multiple=multiple, delimiter='<br>', indent='&nbsp;&nbsp;&nbsp;&nbsp;', multipleShowIndex=multipleShowIndex)
 
-        messageLines = []
-        self._formatMessage(msg, label, messageList=messageLines, multiple=multiple, delimiter='<br>', indent='&nbsp;&nbsp;&nbsp;&nbsp;', multipleShowIndex=multipleShowIndex)
+            # join into a single body string
+            bodyParts = []
+            bodyParts.append(self._getFieldsInString(header, document=document))
+            for line in messageLines:
+                bodyParts.append(self._getFieldsInString(line, document=document))
+            body = u'<br>'.join(bodyParts)
 
-        # join into a single body string
-        bodyParts = []
-        bodyParts.append(self._getFieldsInString(header, document=document))
-        for line in messageLines:
-            bodyParts.append(self._getFieldsInString(line, document=document))
-        body = u'<br>'.join(bodyParts)
+            # ----- build subject -----
+            if subject is None:
+                levelAlias = self.LEVEL_MAP[self._normalizeLevel(level)]['display']
+                # try to inject ETQ number safely when document context exists
+                etqNumberText = ''            
+                if document is not None:
+                    # encoded value is allowed in email contexts [file:1]
+                    etqNumberText = document.getField('ETQ$NUMBER', True).getEncodedValue()
+                    if etqNumberText in self._getLabel():
+                        etqNumberText = ''  # already included
 
-        # ----- build subject -----
-        if subject is None:
-            levelAlias = self.LEVEL_MAP[self._normalizeLevel(level)]['display']
-            # try to inject ETQ number safely when document context exists
-            etqNumberText = ''            
-            if document is not None:
-                # encoded value is allowed in email contexts [file:1]
-                etqNumberText = document.getField('ETQ$NUMBER', True).getEncodedValue()
-                if etqNumberText in self._label:
-                    etqNumberText = ''  # already included
+                subject = u'[{}] {}{}'.format(levelAlias, self._getLabel(), ' - {}'.format(etqNumberText) if etqNumberText else '')
 
-            subject = u'[{}] {}{}'.format(levelAlias, self._label, ' - {}'.format(etqNumberText) if etqNumberText else '')
+            subject = self._toUnicode(subject)
 
-        subject = self._toUnicode(subject)
+            # ----- resolve recipients -----
+            recipients = self._resolveRecipients(toEmails=toEmails, toUserIds=toUserIds, toGroup=toGroup)
+            if recipients is None:
+                self.log('email failed: invalid toGroup "{}"'.format(toGroup), level='error')
+                return  # cannot proceed without recipients
 
-        # ----- create and populate PublicMail -----
-        mailObj = PublicMail()
-            
+            mailOptions = {
+                'copyToEmails': copyToEmails,
+                'copyUserIds': copyUserIds,
+                'document': document,
+                'priority': priority,
+                'sendFailureNotification': sendFailureNotification,
+                'attachments': attachments
+            }
+
+            # ----- digest mode: queue instead of sending -----
+            if self._emailDigest is not None and not attachments:
+                self._emailDigest.add(recipients, subject, body, mailOptions)
+                if self._emailDigest.isDue():
+                    self._flushEmailDigest()
+                return
+
+            self._sendMail(self._buildMail(recipients, subject, body, **mailOptions), sendFailureNotification)
+        finally:
+            if openedEvent:
+                self._fieldEventLocal.cache = None
+
+    def _resolveRecipients(self, toEmails=None, toUserIds=None, toGroup=None):
+        """
+        Return a hashable recipient key: ('userIds', (...)) or ('emails', (...)).
+        Returns None if toGroup does not resolve to a profile.
+        Group profile IDs are cached process-wide for GROUP_CACHE_TTL seconds; a missing group is
+        looked up again on the next call, so a group created later is found.
+        """
         if toUserIds:
-            mailObj.setToUserIDs(toUserIds)
-        elif toEmails:
-            mailObj.setToEmails(toEmails)
-        else:            
+            return ('userIds', tuple(toUserIds))
+        if toEmails:
+            return ('emails', tuple(toEmails))
+
+        cache = self._getProcessCache('groupProfiles')
+        entry = cache.get(toGroup)
+        now = time.time()
+        if entry is None or now >= entry[1]:
             groupProfile = PublicECCProfileManager().getUserProfile(toGroup)
-            if groupProfile is not None:
-                mailObj.setToUserIDs([groupProfile.getID()])
-            else:
-                self.log('email failed: invalid toGroup "{}"'.format(toGroup), level='error')
-                return  # cannot proceed without recipients
+            if groupProfile is None:
+                cache.pop(toGroup, None)
+                return None
+            entry = cache[toGroup] = (groupProfile.getID(), now + self.GROUP_CACHE_TTL)
+        return ('userIds', (entry[0],))
+
+    def _buildMail(self, recipients, subject, body, copyToEmails=None, copyUserIds=None, document=None, priority=None, sendFailureNotification=True, attachments=None):
+        """Create and populate a PublicMail for a recipient key from _resolveRecipients()."""
+        mailObj = PublicMail()
+        if self._metrics is not None:
+            self._metrics.addChars('email', len(subject) + len(body))
+
+        recipientType, recipientValues = recipients
+        if recipientType == 'userIds':
+            mailObj.setToUserIDs(list(recipientValues))
+        else:
+            mailObj.setToEmails(list(recipientValues))
 
         if copyToEmails:
             mailObj.setCopyToEmails(copyToEmails)
@@ -309,6 +2003,9 @@ class EtqDebug(object):
         if priority is not None:
             mailObj.setPriority(priority)
 
+        for attachment in attachments or []:
+            mailObj.addAttachment(attachment)
+
         # set sender to current user when possible
         if thisUser is not None and bool(thisUser.getEmail()):
             # using user ID is usually safer because email can be maintained in the profile [file:2]            
@@ -317,22 +2014,174 @@ class EtqDebug(object):
             # fallback to from email if user context is missing
             mailObj.setSenderEmail('no-reply-notifications@etq.com')   
 
-        # ----- send the email -----
+        return mailObj
+
+    def _sendMail(self, mailObj, sendFailureNotification=True):
+        """Send a built PublicMail (through the mail pool if set), falling back to an error log on failure."""
+        if self._mailPool is not None:
+            self._reportMailFailures()
+            self._mailPool.submit(mailObj, sendFailureNotification, onFailure=self._onMailFailure)
+            return
+        start = time.time()
         try:
             PublicMailSender.sendEmail(mailObj, sendFailureNotification)
         except Exception as e:
             # fall back to standard debug logging if email fails
             self.log('sendEmail failed: {}'.format(str(e)), 'EtqDebug.email', level='error')
+        finally:
+            if self._metrics is not None:
+                self._metrics.addSeconds('send', time.time() - start)
+
+    def _onMailFailure(self, mailObj, error):
+        """
+        Called on a pool worker thread after the last retry fails. Worker threads have no script or
+        document context, so the failure is only queued; the script's thread logs it on its next
+        email() or flush().
+        """
+        self._mailFailures.append((mailObj, error))
+
+    def _reportMailFailures(self):
+        """Log queued mail pool failures with level='error' from the calling (script) thread."""
+        while self._mailFailures:
+            try:
+                mailObj, error = self._mailFailures.popleft()
+            except IndexError:
+                return
+            self.log('sendEmail failed: {}'.format(str(error)), 'EtqDebug.email', level='error', showCaller=False)
+
+    def setMailPool(self, mailPool):
+        """Send mails through an EtqDebugMailWorkerPool (None sends synchronously)."""
+        self._reportMailFailures()
+        self._mailPool = mailPool
+        if mailPool is not None:
+            self._registerExitReport()
 
-    def databaseTableInfo(self, tableName, schemaName='dbo', includeRowCount=True, filterOnlyDataSource='FILTER_ONLY', filterName='VAR$FILTER'):
+    def setEmailDigest(self, digest):
+        """
+        Enable digest mode with an EtqDebugEmailDigest (None sends every email immediately).
+        Anything queued in the previous digest is sent first.
+        """
+        if self._emailDigest is not None:
+            self._flushEmailDigest(force=True)
+        self._emailDigest = digest
+
+    def _flushEmailDigest(self, force=False):
+        """Send one consolidated mail per recipient from the digest."""
+        if self._emailDigest is None:
+            return
+        for recipients, subject, body, mailOptions in self._emailDigest.drain(force=force):
+            self._sendMail(self._buildMail(recipients, subject, body, **mailOptions), mailOptions.get('sendFailureNotification', True))
+
+    def databaseTableInfo(self, tableName, schemaName='dbo', includeRowCount=True, filterOnlyDataSource='FILTER_ONLY', filterName='VAR$FILTER', useCache=True):
         """
         Fetch comprehensive metadata for a table from INFORMATION_SCHEMA.
         Returns: dict with 'columns', 'indexes', 'constraints', 'rowCount', 'tableName'
         Note: Optimized for MySQL; adjust for SQL Server if needed.
         ETQ auto-prefixes table names with environment UUID, so pass the logical table name.
+        Results come from the shared schema cache when useCache=True (see databaseTablesInfo).
         """
         try:
-            info = {
+            info = self.databaseTablesInfo([tableName], schemaName=schemaName, includeRowCount=includeRowCount, filterOnlyDataSource=filterOnlyDataSource, filterName=filterName, useCache=useCache, logResults=False)[tableName]
+            self.log(info, "Database table info: {}.{}".format(schemaName, tableName), multiple=True, enabled=True)
+            return info
+    
+        except Exception as e:
+            self.log("Failed to fetch info for {}.{}: {}".format(schemaName, tableName, str(e)), label="databaseTableInfo", enabled=True)
+            return {}
+
+    def databaseTablesInfo(self, tableNames, schemaName='dbo', includeRowCount=True, filterOnlyDataSource='FILTER_ONLY', filterName='VAR$FILTER', useCache=True, cacheTtl=None, logResults=True):
+        """
+        Fetch columns, indexes, constraints and row estimates for several tables in a single
+        INFORMATION_SCHEMA round trip (one UNION ALL query for every table not already cached).
+        Returns: dict of tableName -> info dict (same shape as databaseTableInfo)
+        Results are kept in a process-wide cache for cacheTtl seconds (default SCHEMA_CACHE_TTL);
+        use clearSchemaCache() to invalidate. Errors propagate to the caller.
+        """
+        cache = self._getProcessCache('schemaCache')
+        ttl = cacheTtl if cacheTtl is not None else self.SCHEMA_CACHE_TTL
+        now = time.time()
+        cacheKey = lambda name: (filterOnlyDataSource, schemaName.lower(), name.lower())
+
+        results = {}
+        missing = []
+        for tableName in tableNames:
+            entry = cache.get(cacheKey(tableName)) if useCache else None
+            hit = entry is not None and now - entry['cachedAt'] < ttl and (entry['hasRowCount'] or not includeRowCount)
+            if self._metrics is not None:
+                self._metrics.cacheLookup('schema', hit)
+            if hit:
+                results[tableName] = copy.deepcopy(entry['info'])
+            elif tableName not in missing:
+                missing.append(tableName)
+
+        if missing:
+            fetched = self._fetchTablesInfo(missing, schemaName, includeRowCount, filterOnlyDataSource, filterName)
+            for tableName in missing:
+                info = fetched[tableName.lower()]
+                info['tableName'] = tableName
+                cache[cacheKey(tableName)] = {'info': info, 'cachedAt': now, 'hasRowCount': includeRowCount}
+                results[tableName] = copy.deepcopy(info)
+
+        if logResults:
+            for tableName in tableNames:
+                self.log(results[tableName], "Database table info: {}.{}".format(schemaName, tableName), multiple=True, enabled=True, callerDepth=1)
+        return results
+
+    def clearSchemaCache(self, tableName=None, schemaName=None):
+        """Invalidate cached table metadata (everything, one schema, or one table)."""
+        cache = self._getProcessCache('schemaCache')
+        for key in list(cache.keys()):
+            if schemaName is not None and key[1] != schemaName.lower():
+                continue
+            if tableName is not None and key[2] != tableName.lower():
+                continue
+            cache.pop(key, None)
+
+    def _fetchTablesInfo(self, tableNames, schemaName, includeRowCount, filterOnlyDataSource, filterName):
+        """Run the combined metadata query; returns lowercase tableName -> info dict."""
+        quote = lambda value: "'{}'".format(value.replace("'", "''"))
+        tableList = ', '.join(quote(name) for name in tableNames)
+        schema = quote(schemaName)
+        excluded = "('information_schema', 'mysql', 'performance_schema')"
+
+        # Every branch returns KIND, TABLE_NAME, GROUP_KEY, SEQ, V1..V5 (text) and N1 (numeric)
+        parts = [
+            '\n'.join([
+                "SELECT 'column' AS KIND, TABLE_NAME, '' AS GROUP_KEY, ORDINAL_POSITION AS SEQ,",
+                "  COLUMN_NAME AS V1, DATA_TYPE AS V2, CHARACTER_MAXIMUM_LENGTH AS V3, IS_NULLABLE AS V4, COLUMN_KEY AS V5, NULL AS N1",
+                "FROM INFORMATION_SCHEMA.COLUMNS",
+                "WHERE TABLE_NAME IN ({})".format(tableList),
+                "  AND TABLE_SCHEMA NOT IN {} AND TABLE_SCHEMA = {}".format(excluded, schema)
+            ]),
+            '\n'.join([
+                "SELECT 'index', TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, NON_UNIQUE, NULL, NULL, NULL, NULL",
+                "FROM INFORMATION_SCHEMA.STATISTICS",
+                "WHERE TABLE_NAME IN ({})".format(tableList),
+                "  AND TABLE_SCHEMA NOT IN {} AND TABLE_SCHEMA = {}".format(excluded, schema)
+            ]),
+            '\n'.join([
+                "SELECT 'constraint', tc.TABLE_NAME, tc.CONSTRAINT_NAME, kcu.ORDINAL_POSITION,",
+                "  tc.CONSTRAINT_TYPE, kcu.COLUMN_NAME, kcu.REFERENCED_TABLE_NAME, kcu.REFERENCED_COLUMN_NAME, NULL, NULL",
+                "FROM INFORMATION_SCHEMA.TABLE_CONSTRAINTS tc",
+                "LEFT JOIN INFORMATION_SCHEMA.KEY_COLUMN_USAGE kcu",
+                "  ON kcu.CONSTRAINT_SCHEMA = tc.CONSTRAINT_SCHEMA AND kcu.CONSTRAINT_NAME = tc.CONSTRAINT_NAME AND kcu.TABLE_NAME = tc.TABLE_NAME",
+                "WHERE tc.TABLE_NAME IN ({})".format(tableList),
+                "  AND tc.TABLE_SCHEMA NOT IN {} AND tc.TABLE_SCHEMA = {}".format(excluded, schema)
+            ])
+        ]
+        # Row estimates (optional, can be slow on large tables)
+        if includeRowCount:
+            parts.append('\n'.join([
+                "SELECT 'rows', TABLE_NAME, '', 0, NULL, NULL, NULL, NULL, NULL, TABLE_ROWS",
+                "FROM INFORMATION_SCHEMA.TABLES",
+                "WHERE TABLE_NAME IN ({})".format(tableList),
+                "  AND TABLE_SCHEMA NOT IN {} AND TABLE_SCHEMA = {}".format(excluded, schema)
+            ]))
+        query = '\nUNION ALL\n'.join(parts) + '\nORDER BY TABLE_NAME, KIND, GROUP_KEY, SEQ'
+
+        infos = {}
+        for tableName in tableNames:
+            infos[tableName.lower()] = {
                 'tableName': tableName,
                 'schema': schemaName,
                 'columns': [],
@@ -340,163 +2189,705 @@ class EtqDebug(object):
                 'constraints': [],
                 'rowCount': None
             }
-            
-            # Fetch columns (MySQL INFORMATION_SCHEMA)
-            columnsQuery = '\n'.join([
-                "SELECT COLUMN_NAME, DATA_TYPE, CHARACTER_MAXIMUM_LENGTH, IS_NULLABLE, COLUMN_KEY",
-                "FROM INFORMATION_SCHEMA.COLUMNS",
-                "WHERE TABLE_NAME = '{}'".format(tableName),
-                "  AND TABLE_SCHEMA NOT IN ('information_schema', 'mysql', 'performance_schema') AND TABLE_SCHEMA = '{}'".format(schemaName),
-                "ORDER BY ORDINAL_POSITION"
-            ])
-            
-            dao = thisApplication.executeQueryFromDatasource(filterOnlyDataSource, {filterName: columnsQuery})
-            while dao.next():
+
+        dao = self._runMetadataQuery(query, filterOnlyDataSource, filterName)
+        while dao.next():
+            info = infos.get((dao.getValue('TABLE_NAME') or '').lower())
+            if info is None:
+                continue
+            kind = dao.getValue('KIND')
+            groupKey = dao.getValue('GROUP_KEY')
+            if kind == 'column':
                 info['columns'].append({
-                    'name': dao.getValue('COLUMN_NAME'),
-                    'type': dao.getValue('DATA_TYPE'),
-                    'maxLength': dao.getValue('CHARACTER_MAXIMUM_LENGTH') or 'N/A',
-                    'nullable': dao.getValue('IS_NULLABLE'),
-                    'key': dao.getValue('COLUMN_KEY') or ''
+                    'name': dao.getValue('V1'),
+                    'type': dao.getValue('V2'),
+                    'maxLength': dao.getValue('V3') or 'N/A',
+                    'nullable': dao.getValue('V4'),
+                    'key': dao.getValue('V5') or ''
                 })
-        
-            # Fetch indexes (MySQL)
-            indexesQuery = '\n'.join([
-                "SELECT INDEX_NAME, COLUMN_NAME, SEQ_IN_INDEX",
-                "FROM INFORMATION_SCHEMA.STATISTICS",
-                "WHERE TABLE_NAME = '{}'".format(tableName),
-                "  AND TABLE_SCHEMA NOT IN ('information_schema', 'mysql', 'performance_schema') AND TABLE_SCHEMA = '{}'".format(schemaName),
-                "ORDER BY INDEX_NAME, SEQ_IN_INDEX"
-            ])
-            
-            dao = thisApplication.executeQueryFromDatasource(filterOnlyDataSource, {filterName: indexesQuery})
-            currentIndex = None
-            while dao.next():
-                idxName = dao.getValue('INDEX_NAME')
-                if idxName != currentIndex:
-                    currentIndex = idxName
-                    info['indexes'].append({'name': idxName, 'columns': []})
-                if info['indexes']:
-                    info['indexes'][-1]['columns'].append(dao.getValue('COLUMN_NAME'))
-        
-            # Fetch row count (optional, can be slow on large tables)
-            if includeRowCount:
-                countQuery = '\n'.join([
-                    "SELECT TABLE_ROWS AS rowCount",
-                    "FROM INFORMATION_SCHEMA.TABLES",
-                    "WHERE TABLE_NAME = '{}'".format(tableName),
-                    "  AND TABLE_SCHEMA NOT IN ('information_schema', 'mysql', 'performance_schema') AND TABLE_SCHEMA = '{}'".format(schemaName)
-                ])
-                dao = thisApplication.executeQueryFromDatasource(filterOnlyDataSource, {filterName: countQuery})
-                if dao.next():
-                    info['rowCount'] = dao.getValue('rowCount')
-        
-            self.log(info, "Database table info: {}.{}".format(schemaName, tableName), multiple=True, enabled=True)
-            return info
-    
+            elif kind == 'index':
+                if not info['indexes'] or info['indexes'][-1]['name'] != groupKey:
+                    info['indexes'].append({'name': groupKey, 'columns': [], 'unique': str(dao.getValue('V2')) == '0'})
+                info['indexes'][-1]['columns'].append(dao.getValue('V1'))
+            elif kind == 'constraint':
+                if not info['constraints'] or info['constraints'][-1]['name'] != groupKey:
+                    info['constraints'].append({'name': groupKey, 'type': dao.getValue('V1'), 'columns': [], 'referencedTable': dao.getValue('V3'), 'referencedColumns': []})
+                constraint = info['constraints'][-1]
+                if dao.getValue('V2') is not None:
+                    constraint['columns'].append(dao.getValue('V2'))
+                if dao.getValue('V4') is not None:
+                    constraint['referencedColumns'].append(dao.getValue('V4'))
+            elif kind == 'rows':
+                rowCount = dao.getValue('N1')
+                info['rowCount'] = int(rowCount) if rowCount is not None else None
+        return infos
+
+    @staticmethod
+    def _getProcessCache(name):
+        """
+        Return a dict shared by every EtqDebug in this interpreter. The script profile is
+        exec'd again by every script, so class attributes do not outlive a single script;
+        caches meant to span scripts live on a registry module in sys.modules instead.
+        Caches holding script objects (_callerCache, _instances) stay class attributes.
+        """
+        registry = sys.modules.get('_etqDebugRegistry')
+        if registry is None:
+            registry = sys.modules.setdefault('_etqDebugRegistry', types.ModuleType('_etqDebugRegistry'))
+        return registry.__dict__.setdefault(name, {})
+
+    def _getDao(self):
+        """Open a DAO connection for the current application."""
+        from com.etq.reliance.dao import DaoFactory
+        return DaoFactory.getInstance().getDao(thisApplication.getName())
+
+    def _getSessionDao(self):
+        """The DAO of this thread's active daoSession(), or None."""
+        return getattr(self._daoLocal, 'dao', None)
+
+    def _acquireDao(self):
+        """Return the daoSession() DAO if one is active, otherwise open a new connection."""
+        sessionDao = self._getSessionDao()
+        if sessionDao is not None:
+            return sessionDao
+        return self._getDao()
+
+    def _releaseDao(self, dao):
+        """Close a DAO from _acquireDao() unless it belongs to the active session."""
+        if dao is not None and dao is not self._getSessionDao():
+            dao.closeDatabaseConnection()
+
+    @contextlib.contextmanager
+    def daoSession(self):
+        """
+        Hold one DAO connection for every executeQuery / databaseTableInfo call in the block:
+            with debug.daoSession():
+                debug.executeQuery(q1)
+                debug.databaseTableInfo('users')
+        Nested sessions reuse the outer connection. The DAO is closed when the outer block exits.
+        Sessions are per thread, so worker threads (e.g. runBatch) each hold their own DAO.
+        """
+        sessionDao = self._getSessionDao()
+        if sessionDao is not None:
+            yield sessionDao
+            return
+
+        self._daoLocal.dao = self._getDao()
+        try:
+            yield self._daoLocal.dao
+        finally:
+            dao, self._daoLocal.dao = self._daoLocal.dao, None
+            dao.closeDatabaseConnection()
+
+    def _runMetadataQuery(self, query, filterOnlyDataSource='FILTER_ONLY', filterName='VAR$FILTER'):
+        """
+        Run a metadata query and return a DAO positioned before the first row.
+        Uses the daoSession() connection when one is active, otherwise the filter-only datasource.
+        """
+        sessionDao = self._getSessionDao()
+        if sessionDao is not None:
+            sessionDao.execute(query)
+            return sessionDao
+        return thisApplication.executeQueryFromDatasource(filterOnlyDataSource, {filterName: query})
+
+    def executeQueries(self, queries, title='Query Batch', level='debug', **kwargs):
+        """
+        Run several queries through executeQuery on one shared DAO and log a timing summary.
+        queries: list of query strings, (title, query) pairs, or dicts of executeQuery arguments
+        **kwargs: default executeQuery arguments for every query
+        Returns a list of executeQuery results in input order.
+        """
+        results = []
+        timings = []
+        with self.daoSession():
+            for index, item in enumerate(queries):
+                options = dict(kwargs)
+                if isinstance(item, dict):
+                    options.update(item)
+                elif isinstance(item, (tuple, list)):
+                    options['title'], options['query'] = item
+                else:
+                    options['query'] = item
+                options.setdefault('title', '{} #{}'.format(title, index + 1))
+                options.setdefault('level', level)
+
+                start = time.time()
+                results.append(self.executeQuery(**options))
+                timings.append((options['title'], (time.time() - start) * 1000.0))
+
+        self._logQueryTimings(timings, title, level=level)
+        return results
+
+    def runBatch(self, tasks, workers=4, title='Batch', maxRows=100, align='center', level='debug', timeout=None, logResults=True, countRows=False, **kwargs):
+        """
+        Run independent queries and table inspections in parallel on a bounded pool of worker
+        threads, each holding its own DAO (a daoSession per thread).
+        tasks: query strings, (title, query) pairs, or dicts with 'query' (plus 'title', 'maxRows', 'countRows')
+               or 'table' (plus 'title' and any databaseTablesInfo() argument)
+        workers: maximum threads (never more than the number of work units)
+        timeout: seconds to wait for the batch; unfinished tasks are reported as timed out
+        countRows: default for query tasks; dao.count() only runs when it is True
+        **kwargs: default databaseTablesInfo() arguments for table tasks (e.g. schemaName)
+        Table tasks with the same options are fetched together in one databaseTablesInfo() call
+        (one UNION ALL round trip); each reports an equal share of its time.
+        Workers only fetch; once all are done the results are logged in input order through the
+        usual table formatting, followed by a timing table.
+        Returns one dict per task in input order: 'title', 'kind' ('query' or 'table'), 'ms', 'error'
+        (None or message) and 'value' ((columns, rows, totalRows, truncated) for queries, with
+        totalRows None unless counted, and the info dict for tables).
+        """
+        tasks = [self._normalizeBatchTask(index, task, title, maxRows, countRows, kwargs) for index, task in enumerate(tasks)]
+        units = self._groupBatchTasks(tasks)
+        results = [None] * len(tasks)
+        pending = iter(range(len(units)))
+        lock = threading.Lock()
+        workerErrors = []
+
+        def work():
+            try:
+                with self.daoSession():
+                    while True:
+                        with lock:
+                            unit = next(pending, None)
+                        if unit is None:
+                            return
+                        for index, result in zip(units[unit], self._runBatchUnit([tasks[index] for index in units[unit]])):
+                            results[index] = result
+            except Exception as e:
+                # The worker could not open (or close) its DAO; its remaining tasks go to other workers
+                workerErrors.append(str(e))
+
+        threads = []
+        for i in range(max(1, min(workers, len(units)))):
+            thread = threading.Thread(target=work, name='EtqDebugBatchWorker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        deadline = time.time() + timeout if timeout is not None else None
+        for thread in threads:
+            thread.join(None if deadline is None else max(0, deadline - time.time()))
+
+        for index, task in enumerate(tasks):
+            if results[index] is None:
+                if any(thread.isAlive() for thread in threads):
+                    error = 'timed out after {} s'.format(timeout)
+                else:
+                    error = 'not run: {}'.format(workerErrors[-1] if workerErrors else 'no worker available')
+                results[index] = {'title': task['title'], 'kind': task['kind'], 'ms': None, 'error': error, 'value': None}
+
+        if logResults:
+            for task, result in zip(tasks, results):
+                self._logBatchResult(task, result, align=align, level=level)
+            timings = [(result['title'] + (' (error)' if result['error'] else ''), result['ms'] or 0.0) for result in results]
+            self._logQueryTimings(timings, title, level=level)
+        return results
+
+    def _normalizeBatchTask(self, index, task, title, maxRows, countRows, tableOptions):
+        """Turn a runBatch() task into a dict with 'kind', 'title' and its arguments (table tasks get tableOptions defaults)."""
+        if isinstance(task, dict):
+            task = dict(task)
+        elif isinstance(task, (tuple, list)):
+            task = {'title': task[0], 'query': task[1]}
+        else:
+            task = {'query': task}
+        task['kind'] = 'table' if 'table' in task else 'query'
+        task.setdefault('maxRows', maxRows)
+        task.setdefault('countRows', countRows)
+        if task['kind'] == 'table':
+            for key, value in tableOptions.items():
+                task.setdefault(key, value)
+            task.setdefault('schemaName', 'dbo')
+        task.setdefault('title', task['table'] if task['kind'] == 'table' else '{} #{}'.format(title, index + 1))
+        return task
+
+    @staticmethod
+    def _batchTableOptions(task):
+        """The databaseTablesInfo() arguments of a runBatch() table task."""
+        return dict((key, value) for key, value in task.items() if key not in ('kind', 'title', 'table', 'maxRows', 'countRows'))
+
+    def _groupBatchTasks(self, tasks):
+        """
+        Split runBatch() tasks into work units (lists of task indexes): one per query task, and one
+        per set of table tasks sharing their databaseTablesInfo() options.
+        """
+        units = []
+        tableUnits = {}
+        for index, task in enumerate(tasks):
+            if task['kind'] != 'table':
+                units.append([index])
+                continue
+            try:
+                key = tuple(sorted(self._batchTableOptions(task).items()))
+                unit = tableUnits.get(key)
+            except TypeError:
+                # Unhashable option values: fetch this table on its own
+                units.append([index])
+                continue
+            if unit is None:
+                unit = tableUnits[key] = []
+                units.append(unit)
+            unit.append(index)
+        return units
+
+    def _runBatchUnit(self, unitTasks):
+        """
+        Run one runBatch() work unit on this thread's session DAO, capturing errors instead of raising.
+        Returns one result dict per task; grouped table tasks split the unit's time evenly.
+        """
+        results = [{'title': task['title'], 'kind': task['kind'], 'ms': None, 'error': None, 'value': None} for task in unitTasks]
+        start = time.time()
+        try:
+            if unitTasks[0]['kind'] == 'table':
+                infos = self.databaseTablesInfo([task['table'] for task in unitTasks], logResults=False, **self._batchTableOptions(unitTasks[0]))
+                for task, result in zip(unitTasks, results):
+                    result['value'] = infos[task['table']]
+            else:
+                task = unitTasks[0]
+                results[0]['value'] = self._fetchQueryRows(task['query'], task['maxRows'], countRows=task['countRows'])
         except Exception as e:
-            self.log("Failed to fetch info for {}.{}: {}".format(schemaName, tableName, str(e)), label="databaseTableInfo", enabled=True)
-            return {}
+            for result in results:
+                result['error'] = str(e)
+        ms = (time.time() - start) * 1000.0 / len(results)
+        for result in results:
+            result['ms'] = ms
+        return results
+
+    def _fetchQueryRows(self, query, maxRows=100, countRows=False):
+        """
+        Execute a query on this thread's DAO without logging; returns (columns, rows, totalRows, truncated).
+        dao.count() only runs when countRows=True (totalRows is None otherwise).
+        Raises ValueError for a non-string query, no columns or duplicate column names.
+        Slow runs still go to the slow-query log.
+        """
+        if not isinstance(query, basestring):
+            raise ValueError('Invalid query type')
+        rawDao = self._acquireDao()
+        try:
+            start = time.time()
+            rawDao.execute(query)
+            executeMs = (time.time() - start) * 1000.0
+            dao = EtqDebugTimedDao(rawDao)
+            columns = [dao.getColumn(i).getName() for i in range(dao.getColumnCount())]
+            if not columns:
+                raise ValueError('No columns found')
+            if len(columns) != len(set(columns)):
+                raise ValueError('Duplicate column names: {}'.format(sorted(set(col for col in columns if columns.count(col) > 1))))
+            totalRows = dao.count() if countRows else None
+            rows = []
+            while (maxRows is None or len(rows) < maxRows) and dao.next():
+                rows.append(tuple(self._queryRowValues(dao, columns)))
+            if totalRows is not None:
+                truncated = totalRows > len(rows)
+            else:
+                truncated = maxRows is not None and len(rows) >= maxRows and dao.next()
+            fetchMs = dao.fetchSeconds * 1000.0
+            if self.SLOW_QUERY_MS is not None and executeMs + fetchMs >= self.SLOW_QUERY_MS:
+                self._addSlowQuery(query, executeMs, fetchMs, dao.rows)
+            return columns, rows, totalRows, truncated
+        finally:
+            self._releaseDao(rawDao)
+
+    def _logBatchResult(self, task, result, align='center', level='debug'):
+        """Log one runBatch() result the way executeQuery / databaseTableInfo would."""
+        if result['error']:
+            self.log(result['error'], '{} failed'.format(result['title']), level='error', enabled=True, callerDepth=1)
+        elif result['kind'] == 'table':
+            self.log(result['value'], 'Database table info: {}.{}'.format(task['schemaName'], task['table']), multiple=True, level=level, enabled=True, callerDepth=1)
+        else:
+            columns, rows, totalRows, truncated = result['value']
+            lines = self._queryTableLines(columns, rows, totalRows=totalRows, truncated=truncated, align=align)
+            self.log(lines, result['title'], multiple=True, level=level, multipleShowIndex=False, enabled=True, callerDepth=1, maxItems=0)
+
+    def _logQueryTimings(self, timings, title, level='debug'):
+        """Log (label, milliseconds) pairs as a piped table with a total row."""
+        rows = [(label, '{:.1f}'.format(ms)) for label, ms in timings]
+        rows.append(('TOTAL', '{:.1f}'.format(sum(ms for label, ms in timings))))
+        lines = self._tableLines(['Query', 'ms'], rows)
+        self.log(lines, '{} timings'.format(title), multiple=True, level=level, multipleShowIndex=False, enabled=True, callerDepth=1, maxItems=0)
+
+    def _tableLines(self, columns, rows, align='left'):
+        """Header, separator and body lines of a piped table sized to fit every value."""
+        rows = [[self._toUnicode(val) for val in row] for row in rows]
+        columnSizes = [max([len(columns[i])] + [len(row[i]) for row in rows]) for i in range(len(columns))]
+        alignFunc = self._ALIGN_FUNCS[align]
+        lines = [self._formatTableRow(columns, columnSizes, alignFunc), '| ' + ' | '.join('-'*w for w in columnSizes) + ' |']
+        lines += [self._formatTableRow(row, columnSizes, alignFunc) for row in rows]
+        return lines
+
+    @staticmethod
+    def _queryRowValues(dao, columns):
+        """The current DAO row as display strings (None becomes '', values are cut at 100 characters)."""
+        return [str(dao.getValue(column) or '')[:100] for column in columns]
+
+    @staticmethod
+    def _queryRowCountLine(shown, totalRows=None, truncated=False):
+        """'Row Count: N (showing M)' when the rows were counted, otherwise 'Rows shown: M'."""
+        if totalRows is None:
+            return 'Rows shown: {}{}'.format(shown, ' (more rows not shown)' if truncated else '')
+        return 'Row Count: {}{}'.format(totalRows, ' (showing {})'.format(shown) if totalRows > shown else '')
+
+    def _queryTableLines(self, columns, rows, totalRows=None, truncated=False, align='center', includeRowCount=True):
+        """Row count line, piped table and a '...' marker when rows were left out, for fetched query rows."""
+        truncated = truncated or (totalRows is not None and totalRows > len(rows))
+        lines = [self._queryRowCountLine(len(rows), totalRows, truncated)] if includeRowCount else []
+        lines += self._tableLines(columns, rows, align=align)
+        if truncated:
+            lines.append('...')
+        return lines
+
+    def _getQueryColumns(self, dao, title):
+        """
+        Return the column names of an executed query, or None (after logging why) when
+        there are no columns or the names are ambiguous.
+        """
+        columns = []
+        columnCount = dao.getColumnCount()
+        if columnCount == 0:
+            self.log('No columns found', title)
+            return None
+
+        for i in range(columnCount):
+            column = dao.getColumn(i)
+            columns.append(column.getName())
+
+        # Detect duplicate column names (e.g. from SELECT * with JOINs)
+        if len(columns) != len(set(columns)):
+            seen = {}
+            for col in columns:
+                seen[col] = seen.get(col, 0) + 1
+            dupes = [col for col, count in seen.items() if count > 1]
+            self.log(
+                'Duplicate column name(s) detected - rewrite query using explicit SELECT aliases: {}'.format(dupes),
+                title, level='warn', enabled=True
+            )
+            return None
+
+        return columns
 
-    def executeQuery(self, query, title='Query Results', output='log', maxRows=100, align='center', includeRowCount=True, level='debug', **kwargs):
+    def _formatTableRow(self, values, columnSizes, alignFunc):
+        """Format one piped table row."""
+        return '| ' + ' | '.join(alignFunc(values[i], columnSizes[i]) for i in range(len(values))) + ' |'
+
+    def executeQuery(self, query, title='Query Results', output='log', maxRows=100, align='center', includeRowCount=True, level='debug', stream=False, chunkSize=200, sampleRows=50, columnWidth=None, countRows=False, compress=False, emailOptions=None, queryStats=False, explain=False, slowQueryMs=None, **kwargs):
         """
         Logs/emails formatted query results as piped table.
-        - output: 'log' (default), 'email'
+        - output: 'log' (default), 'return', 'iter', 'csv'/'email'
+          'iter' returns a generator of raw value tuples; the DAO stays open until it is exhausted or closed
+          'csv'/'email' stream rows into a CSV attachment (gzip when compress=True) sent through email();
+          emailOptions is passed on to email() (e.g. {'toEmails': [...]}) and overrides label, level and enabled
+        - stream: fetch and log rows in blocks of chunkSize instead of building the whole table;
+          column widths come from the first sampleRows rows (or a fixed columnWidth),
+          maxRows=None streams every row, and dao.count() only runs when countRows=True
+        - queryStats: True to log execute time, fetch time and rows fetched once the rows are consumed, at `level`
+          (slow runs are logged at warn either way, even when minLevel would filter them)
+        - explain: True to log the MySQL EXPLAIN plan, 'slow' to log it only for slow queries;
+          it only runs after the query succeeded
+        - slowQueryMs: slow-query threshold in ms (default SLOW_QUERY_MS); slow runs are aggregated
+          by normalized fingerprint, see slowQueryReport()
         - Deprecated kwargs (accepted but ignored): columns, filterOnlyDataSource, filterName
         """
-        from com.etq.reliance.dao import DaoFactory
-        dao = None    
+        instrument = {'queryStats': queryStats, 'explain': explain, 'slowQueryMs': slowQueryMs, 'level': level}
+        if output == 'iter':
+            return self._iterQuery(query, title=title, maxRows=maxRows, instrument=instrument)
+
+        dao = None
+        rawDao = None
+        executeSeconds = None
+        failed = False
         try:
             if not isinstance(query, basestring):                
                 self.log('Invalid query type', title)
                 return
 
-            dao = DaoFactory.getInstance().getDao(thisApplication.getName())
-            dao.execute(query)
+            rawDao = self._acquireDao()
+            start = time.time()
+            rawDao.execute(query)
+            executeSeconds = time.time() - start
+            dao = EtqDebugTimedDao(rawDao)
                
-            columns = []
-            columnCount = dao.getColumnCount()
-            if columnCount == 0:
-                self.log('No columns found', title)
+            columns = self._getQueryColumns(dao, title)
+            if columns is None:
+                failed = True
                 return
 
-            for i in range(columnCount):
-                column = dao.getColumn(i)
-                columns.append(column.getName())
+            self.log('Columns: {}'.format(columns))
+
+            if output in ('csv', 'email'):
+                return self._emailQueryCsv(dao, columns, title, maxRows=maxRows, compress=compress, level=level, emailOptions=emailOptions)
 
-            # Detect duplicate column names (e.g. from SELECT * with JOINs)
-            if len(columns) != len(set(columns)):
-                seen = {}
-                for col in columns:
-                    seen[col] = seen.get(col, 0) + 1
-                dupes = [col for col, count in seen.items() if count > 1]
-                self.log(
-                    'Duplicate column name(s) detected - rewrite query using explicit SELECT aliases: {}'.format(dupes),
-                    title, level='warn', enabled=True
-                )
+            if stream and output == 'log':
+                self._streamQueryTable(dao, columns, title, maxRows=maxRows, align=align, includeRowCount=includeRowCount, level=level, chunkSize=chunkSize, sampleRows=sampleRows, columnWidth=columnWidth, countRows=countRows)
                 return
 
-            self.log('Columns: {}'.format(columns))
-
-            columnSizes = [len(col) for col in columns]
-            
-            rowCount = 0
             rowData = []
             totalRows = dao.count()
-            while dao.next() and rowCount < maxRows:
-                row = []
-                for i, column in enumerate(columns):
-                    val = str(dao.getValue(column) or '')[:100]
-                    columnSizes[i] = max(columnSizes[i], len(val))
-                    row.append(val)
-                rowData.append(tuple(row))
-                rowCount += 1
+            while (maxRows is None or len(rowData) < maxRows) and dao.next():
+                rowData.append(tuple(self._queryRowValues(dao, columns)))
 
             if output =='return':
                 return columns, rowData            
             
             elif output == 'log':           
-                alignFunc = {
-                    'left': lambda s, w: s.ljust(w),
-                    'center': lambda s, w: s.center(w),
-                    'right': lambda s, w: s.rjust(w)
-                }[align]
-                
-                pad = lambda s, i: alignFunc(s, columnSizes[i])
-
-                lines = []
-                if includeRowCount:
-                    lines.append('Row Count: {}{}'.format(totalRows, ' (showing {})'.format(min(rowCount, maxRows)) if totalRows > maxRows else ''))
-                headerRow = ['| ' + ' | '.join(pad(columns[i], i) for i in range(len(columns))) + ' |']
-                sepRow = ['| ' + ' | '.join('-'*w for w in columnSizes) + ' |']
-                bodyRows = ['| ' + ' | '.join(pad(row[i], i) for i in range(len(row))) + ' |' for row in rowData]
-                
-                if totalRows > maxRows:
-                    bodyRows.append('...')
-                
-                lines += headerRow + sepRow + bodyRows
-                
-                self.log(lines, title, multiple=True, level=level, multipleShowIndex=False, enabled=True)           
-            
-            elif output == 'email':
-                #todo
-                # lines = [','.join(columns)]
-                # for row in rowData:
-                #     safeRow = [str(val).replace(',', ';') for val in row]
-                #     lines.append(','.join(safeRow))
-                # return '\n'.join(lines)
-                # attach = PublicAttachment()
-                # attach.setFileName(filename)
-                # attach.setContent(csvContent)
-                # self.email(lines, title, multiple=True, multipleShowIndex=False, enabled=True)
-                return
+                lines = self._queryTableLines(columns, rowData, totalRows=totalRows, align=align, includeRowCount=includeRowCount)
+                self.log(lines, title, multiple=True, level=level, multipleShowIndex=False, enabled=True, maxItems=0)           
 
         except Exception as e:
+            failed = True
             self.log(str(e), label='daoTable failed', level='error', enabled=True)
 
         finally:
-            if dao is not None:
-                dao.closeDatabaseConnection()
+            if executeSeconds is not None:
+                self._recordQuery(rawDao, query, title, executeSeconds, dao, failed=failed, **instrument)
+            self._releaseDao(rawDao)
+
+    def _iterQuery(self, query, title='Query Results', maxRows=None, instrument=None):
+        """
+        Generator behind executeQuery(output='iter'): yields one tuple of raw values per row.
+        The DAO is opened on the first next() and closed when the generator is exhausted,
+        closed, or garbage collected.
+        """
+        if not isinstance(query, basestring):
+            self.log('Invalid query type', title)
+            return
+
+        dao = None
+        rawDao = None
+        executeSeconds = None
+        failed = False
+        try:
+            rawDao = self._acquireDao()
+            start = time.time()
+            rawDao.execute(query)
+            executeSeconds = time.time() - start
+            dao = EtqDebugTimedDao(rawDao)
+            columns = self._getQueryColumns(dao, title)
+            if columns is None:
+                failed = True
+                return
+            rowCount = 0
+            while (maxRows is None or rowCount < maxRows) and dao.next():
+                yield tuple([dao.getValue(column) for column in columns])
+                rowCount += 1
+        except Exception as e:
+            failed = True
+            self.log(str(e), label='daoTable failed', level='error', enabled=True)
+        finally:
+            if executeSeconds is not None:
+                self._recordQuery(rawDao, query, title, executeSeconds, dao, failed=failed, **(instrument or {}))
+            self._releaseDao(rawDao)
+
+    def _recordQuery(self, dao, query, title, executeSeconds, timedDao, queryStats=False, explain=False, slowQueryMs=None, level='debug', failed=False):
+        """
+        Instrumentation for one executeQuery() run, called once its rows are consumed:
+        logs the stats line, feeds the slow-query log and runs EXPLAIN when asked
+        (never after a failed run, e.g. an error or duplicate column names).
+        """
+        executeMs = executeSeconds * 1000.0
+        fetchMs = timedDao.fetchSeconds * 1000.0 if timedDao is not None else 0.0
+        rows = timedDao.rows if timedDao is not None else 0
+        threshold = self.SLOW_QUERY_MS if slowQueryMs is None else slowQueryMs
+        slow = threshold is not None and executeMs + fetchMs >= threshold
+
+        if queryStats or slow:
+            # Slow runs are always logged and forced through minLevel; routine stats are opt-in and follow the caller's level
+            self.log('execute {:.1f} ms, fetch {:.1f} ms, {} row(s) fetched{}'.format(
+                executeMs, fetchMs, rows, ' - slow query (>= {} ms)'.format(threshold) if slow else ''),
+                '{} stats'.format(title), level='warn' if slow else level, enabled=True if slow else None, callerDepth=1)
+        if slow:
+            self._addSlowQuery(query, executeMs, fetchMs, rows)
+        if not failed and (explain is True or (explain == 'slow' and slow)):
+            self._logExplain(dao, query, title, level=level)
+
+    def _logExplain(self, dao, query, title, level='debug'):
+        """Run EXPLAIN (MySQL) for a query on the given DAO and log the plan as a piped table."""
+        try:
+            dao.execute('EXPLAIN ' + query)
+            columns = self._getQueryColumns(dao, '{} EXPLAIN'.format(title))
+            if columns is None:
+                return
+            rows = []
+            while dao.next():
+                rows.append(['' if value is None else value for value in [dao.getValue(column) for column in columns]])
+            self.log(self._tableLines(columns, rows), '{} EXPLAIN'.format(title), multiple=True, level=level, multipleShowIndex=False, enabled=True, callerDepth=2, maxItems=0)
+        except Exception as e:
+            self.log('EXPLAIN failed: {}'.format(e), title, level='warn', enabled=True, callerDepth=2)
+
+    @staticmethod
+    def _fingerprintQuery(query):
+        """
+        Normalize a query for the slow-query log (literals and numbers become ?, IN lists collapse,
+        comments and whitespace are dropped, lower case). Returns (normalized, 12-char md5 fingerprint).
+        """
+        import hashlib
+        import re
+        normalized = re.sub(r"'(?:[^'\\]|\\.|'')*'", '?', query)
+        normalized = re.sub(r'"(?:[^"\\]|\\.)*"', '?', normalized)
+        normalized = re.sub(r'/\*.*?\*/|--[^\n]*|#[^\n]*', ' ', normalized, flags=re.S)
+        normalized = re.sub(r'\b\d+(?:\.\d+)?\b', '?', normalized)
+        normalized = re.sub(r'\s+', ' ', normalized).strip().lower()
+        normalized = re.sub(r'\(\s*\?(?:\s*,\s*\?)+\s*\)', '(?+)', normalized)
+        if isinstance(normalized, unicode):
+            normalized = normalized.encode('utf-8')
+        return normalized, hashlib.md5(normalized).hexdigest()[:12]
+
+    def _addSlowQuery(self, query, executeMs, fetchMs, rows):
+        """Aggregate one slow run under its fingerprint in the process-wide slow-query log."""
+        normalized, fingerprint = self._fingerprintQuery(query)
+        totalMs = executeMs + fetchMs
+        entries = self._getProcessCache('slowQueries')
+        with self._getProcessCache('locks').setdefault('slowQueries', threading.Lock()):
+            entry = entries.get(fingerprint)
+            if entry is None:
+                if len(entries) >= self.SLOW_QUERY_MAX_ENTRIES:
+                    # Make room by dropping the fingerprint with the least total time
+                    del entries[min(entries, key=lambda key: entries[key]['totalMs'])]
+                entry = entries[fingerprint] = {'fingerprint': fingerprint, 'query': normalized, 'sample': query[:500],
+                    'count': 0, 'totalMs': 0.0, 'maxMs': 0.0, 'executeMs': 0.0, 'fetchMs': 0.0, 'rows': 0, 'lastSeen': None}
+            entry['count'] += 1
+            entry['totalMs'] += totalMs
+            entry['maxMs'] = max(entry['maxMs'], totalMs)
+            entry['executeMs'] += executeMs
+            entry['fetchMs'] += fetchMs
+            entry['rows'] += rows
+            entry['lastSeen'] = time.time()
+
+    def slowQueryReport(self, top=20, sortBy='totalMs', reset=False, level='warn', logResults=True):
+        """
+        Log the process-wide slow-query log as a table (one row per fingerprint) and return its
+        entries as dicts, sorted by sortBy ('totalMs', 'count', 'maxMs' or 'avgMs').
+        reset: clear the log afterwards
+        """
+        entries = self._getProcessCache('slowQueries')
+        with self._getProcessCache('locks').setdefault('slowQueries', threading.Lock()):
+            report = [dict(entry, avgMs=entry['totalMs'] / entry['count']) for entry in entries.values()]
+            if reset:
+                entries.clear()
+        report.sort(key=lambda entry: entry[sortBy], reverse=True)
+        report = report[:top] if top else report
+
+        if logResults:
+            if not report:
+                self.log('No slow queries recorded', 'Slow queries', level=level, enabled=True, callerDepth=1)
+            else:
+                rows = [(entry['fingerprint'], entry['count'], '{:.1f}'.format(entry['totalMs']), '{:.1f}'.format(entry['avgMs']),
+                         '{:.1f}'.format(entry['maxMs']), '{:.1f}'.format(entry['fetchMs'] / entry['count']), entry['rows'] // entry['count'], entry['query'][:80])
+                        for entry in report]
+                lines = self._tableLines(['Fingerprint', 'Count', 'Total ms', 'Avg ms', 'Max ms', 'Avg fetch ms', 'Avg rows', 'Query'], rows)
+                self.log(lines, 'Slow queries', multiple=True, level=level, multipleShowIndex=False, enabled=True, callerDepth=1, maxItems=0)
+        return report
+
+    def clearSlowQueries(self):
+        """Empty the process-wide slow-query log."""
+        self._getProcessCache('slowQueries').clear()
+
+    def _csvValue(self, value):
+        """Encode a DAO value for csv.writer (Jython 2.7 csv needs byte strings)."""
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def _emailQueryCsv(self, dao, columns, title, maxRows=None, compress=False, level='debug', emailOptions=None):
+        """
+        Write an executed query straight into a CSV (optionally gzip) buffer and email it
+        as an attachment. Returns the number of rows written.
+        """
+        import csv
+        import gzip
+        import re
+        from cStringIO import StringIO
+
+        fileName = (re.sub(r'[^A-Za-z0-9_-]+', '_', title).strip('_') or 'query') + ('.csv.gz' if compress else '.csv')
+        buf = StringIO()
+        target = gzip.GzipFile(fileName[:-3], mode='wb', fileobj=buf) if compress else buf
+        writer = csv.writer(target)
+        writer.writerow([self._csvValue(column) for column in columns])
+        rowCount = 0
+        while (maxRows is None or rowCount < maxRows) and dao.next():
+            writer.writerow([self._csvValue(dao.getValue(column)) for column in columns])
+            rowCount += 1
+        truncated = maxRows is not None and rowCount >= maxRows and dao.next()
+        if compress:
+            target.close()
+
+        attachment = PublicAttachment()
+        attachment.setFileName(fileName)
+        attachment.setContent(buf.getvalue())
+        buf.close()
+
+        summary = '{} row(s){} attached as {}'.format(rowCount, ' (limited by maxRows)' if truncated else '', fileName)
+        # emailOptions override the defaults here; the CSV is always attached and callerDepth
+        # stays relative to the executeQuery() caller
+        options = {'label': title, 'level': level, 'enabled': True}
+        options.update(emailOptions or {})
+        options['msg'] = summary
+        options['attachments'] = [attachment] + list(options.get('attachments') or [])
+        options['callerDepth'] = 1 + (options.get('callerDepth') or 0)
+        self.email(**options)
+        return rowCount
+
+    def _streamQueryTable(self, dao, columns, title, maxRows=None, align='center', includeRowCount=True, level='debug', chunkSize=200, sampleRows=50, columnWidth=None, countRows=False):
+        """
+        Log an executed query as piped table blocks of at most chunkSize rows, holding only
+        the sample window and the current block in memory.
+        Values wider than their column (sized from the sample or columnWidth) are truncated.
+        Returns the number of rows logged.
+        """
+        alignFunc = self._ALIGN_FUNCS[align]
+        totalRows = dao.count() if countRows else None
+        readRow = lambda: self._queryRowValues(dao, columns)
+
+        # Size columns from a sample window, or use the fixed width
+        sample = []
+        exhausted = [False]  # shared with iterRows()
+        if columnWidth is None:
+            while len(sample) < sampleRows and (maxRows is None or len(sample) < maxRows):
+                if not dao.next():
+                    exhausted[0] = True
+                    break
+                sample.append(readRow())
+            columnSizes = [len(col) for col in columns]
+            for row in sample:
+                for i, val in enumerate(row):
+                    columnSizes[i] = max(columnSizes[i], len(val))
+        else:
+            columnSizes = [max(columnWidth, len(col)) for col in columns]
+
+        formatRow = lambda row: self._formatTableRow([val[:columnSizes[i]] for i, val in enumerate(row)], columnSizes, alignFunc)
+
+        def iterRows():
+            for row in sample:
+                yield row
+            del sample[:]
+            while not exhausted[0]:
+                if not dao.next():
+                    exhausted[0] = True
+                    break
+                yield readRow()
+
+        block = [self._formatTableRow(columns, columnSizes, alignFunc), '| ' + ' | '.join('-'*w for w in columnSizes) + ' |']
+        blockLabel = lambda first, last: '{} [rows {}-{}]'.format(title, first, last) if last >= first else '{} [no rows]'.format(title)
+        firstRow = 1
+        rowCount = 0
+        for row in iterRows():
+            # A full block is only logged once another row arrives, so the trailer below never
+            # lands in a block of its own
+            if rowCount - firstRow + 1 >= chunkSize:
+                self.log(block, blockLabel(firstRow, rowCount), multiple=True, level=level, multipleShowIndex=False, enabled=True, callerDepth=1, maxItems=0)
+                block = []
+                firstRow = rowCount + 1
+            block.append(formatRow(row))
+            rowCount += 1
+            if maxRows is not None and rowCount >= maxRows:
+                break
+
+        truncated = not exhausted[0] and dao.next()
+        if truncated:
+            block.append('...')
+        if includeRowCount:
+            block.append(self._queryRowCountLine(rowCount, totalRows, truncated))
+        self.log(block, blockLabel(firstRow, rowCount), multiple=True, level=level, multipleShowIndex=False, enabled=True, callerDepth=1, maxItems=0)
+        return rowCount
 
     def profileCode(self, codeOrFunc, *args, **kwargs):
         """
@@ -508,6 +2899,12 @@ class EtqDebug(object):
             *args: Arguments for the function (if profiling a function).
             globals (dict, optional): Pass globals() from the calling scope (if profiling a string).
             locals (dict, optional): Pass locals() from the calling scope (if profiling a string).
+            profileOptions (dict, optional): Profiler settings, kept apart from the function's own kwargs:
+                mode: 'profile' (default, deterministic) or 'sample' (EtqDebugSampler)
+                top: only log the top N functions
+                sampleInterval: seconds between samples in 'sample' mode (default 0.005)
+                collapsed: also log collapsed stacks in 'sample' mode
+                sampleRate: fraction of runs sampled in 'sample' mode (default 1.0), independent of minLevel
             **kwargs: Keyword arguments for the function (if profiling a function).
         """        
         isString = isinstance(codeOrFunc, str)
@@ -529,6 +2926,19 @@ class EtqDebug(object):
         scopeGlobals = kwargs.pop('globals', {})
         scopeLocals = kwargs.pop('locals', {})
 
+        profileOptions = kwargs.pop('profileOptions', None) or {}
+        mode = profileOptions.get('mode', 'profile')
+        top = profileOptions.get('top')
+        sampleInterval = profileOptions.get('sampleInterval', 0.005)
+        collapsed = profileOptions.get('collapsed', False)
+
+        if mode == 'sample':
+            # The sampler decides from its own rate, so sampled runs also report in production
+            with self.sampling(logLabelName, interval=sampleInterval, top=top or 20, collapsed=collapsed, rate=profileOptions.get('sampleRate', 1.0)):
+                if isString:
+                    exec(codeOrFunc, scopeGlobals, scopeLocals)
+                    return
+                return codeOrFunc(*args, **kwargs)
 
         if not self._shouldLog('debug'):
             if isString:
@@ -562,22 +2972,230 @@ class EtqDebug(object):
         # --- Stats Capture (shared logic) ---
         s = StringIO()
         ps = pstats.Stats(pr, stream=s).sort_stats('cumulative')
-        ps.print_stats()
+        if top:
+            ps.print_stats(top)
+        else:
+            ps.print_stats()
         profileStatsString = s.getvalue()
         statsLines = profileStatsString.strip().split('\n')
         self.log('\n' + '\n'.join(statsLines), logLabel + " - Profile Results:")
         
         return result
     
-    def profileThis(self, func):
+    def profileThis(self, func=None, every=None, threshold=None, accumulate=False, top=None):
         """
         A decorator that profiles a function execution and logs the results 
         using the EtqDebug logger and the internal profileCode method.
+
+        With options it accumulates instead of logging every call:
+            @debug.profileThis(every=100, threshold=0.25, top=20)
+        - every: profile only 1 in N calls (every call is still timed)
+        - threshold: only merge profiled calls that took at least this many seconds
+        - accumulate: merge every call without sampling
+        Merged stats and per-call percentiles are logged by reportProfiles(),
+        which runs on flush(), when a `with` block exits, and at process exit.
         """        
         import functools
+        if func is None:
+            return lambda f: self.profileThis(f, every=every, threshold=threshold, accumulate=accumulate, top=top)
+
+        if not (every or threshold is not None or accumulate):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                # This calls the existing profileCode method using 'self' (the debug instance)
+                return self.profileCode(func, *args, **kwargs)
+            return wrapper
+
+        name = getattr(func, '__name__', 'codeBlock')
+        accumulator = EtqDebugProfileAccumulator(name, every=every, threshold=threshold)
+        self._registerProfileAccumulator(accumulator, top)
+
         @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            # This calls the existing profileCode method using 'self' (the debug instance)
-            return self.profileCode(func, *args, **kwargs)
-            
-        return wrapper
+        def accumulatingWrapper(*args, **kwargs):
+            if not self._shouldLog('debug'):
+                return func(*args, **kwargs)
+
+            profiler = None
+            if accumulator.shouldProfile():
+                import profile
+                profiler = profile.Profile()
+            start = time.time()
+            try:
+                if profiler is not None:
+                    return profiler.runcall(func, *args, **kwargs)
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                accumulator.addDuration(elapsed)
+                if profiler is not None:
+                    accumulator.addProfile(profiler, elapsed)
+
+        return accumulatingWrapper
+
+    def _registerProfileAccumulator(self, accumulator, top):
+        self._registerExitReport()
+        self._profileAccumulators.append((accumulator, top))
+
+    def _registerExitReport(self):
+        """
+        Make sure accumulated profiles and spans are reported when the process exits, as a fallback
+        for scripts that never call flush() or leave a `with` block. One hook is registered per
+        process and it only holds weak references, so instances are not kept alive until shutdown.
+        """
+        if self._exitReportRegistered:
+            return
+        state = self._getProcessCache('exitReport')
+        instances = state.get('instances')
+        if instances is None:
+            import weakref
+            instances = state.setdefault('instances', weakref.WeakValueDictionary())
+        instances[id(self)] = self
+        token = object()
+        if state.setdefault('hook', token) is token:
+            import atexit
+            atexit.register(EtqDebug._runExitReports, instances)
+        self._exitReportRegistered = True
+
+    @staticmethod
+    def _runExitReports(instances):
+        """The process-wide atexit hook: report every registered EtqDebug that is still alive."""
+        for debug in list(instances.values()):
+            try:
+                debug._reportAtExit()
+            except Exception:
+                # Globals of a finished script may no longer be usable; the others still report
+                pass
+
+    def _reportAtExit(self):
+        self.flushThrottled()
+        self.reportProfiles()
+        self.reportSpans()
+        if self._metrics is not None and self._metrics.dumpOnFlush:
+            self.reportMetrics()
+        self._reportMailFailures()
+        self._sink.flush()
+
+    def reportProfiles(self, reset=True):
+        """Log the merged profile of every accumulating @profileThis function that ran since the last report."""
+        for accumulator, top in self._profileAccumulators:
+            if not accumulator.calls:
+                continue
+            self.log('\n' + '\n'.join(accumulator.report(top=top)), 'ProfilerFunction -> {} - Cumulative Profile Results:'.format(accumulator.name), enabled=True, showCaller=False)
+            if reset:
+                accumulator.reset()
+
+    @staticmethod
+    def _percentile(sortedValues, pct):
+        """Nearest-rank percentile of an already sorted list."""
+        if not sortedValues:
+            return 0.0
+        index = int(round(pct / 100.0 * (len(sortedValues) - 1)))
+        return sortedValues[index]
+
+    @contextlib.contextmanager
+    def sampling(self, label='codeBlock', interval=0.005, top=20, collapsed=False, sortBy='cumulative', callerDepth=0, rate=1.0):
+        """
+        Sample the calling thread's stack while the block runs and log a top-N table
+        (and optionally collapsed stacks) when it exits:
+            with debug.sampling('nightly sync', interval=0.01, rate=0.1):
+                runSync()
+        Cheap enough to leave on for selected production scripts: `rate` is the fraction of
+        blocks sampled (0 = never), and sampled blocks are reported whatever minLevel is.
+        """
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            yield None
+            return
+
+        sampler = EtqDebugSampler(interval=interval)
+        try:
+            sampler.start()
+        except RuntimeError as e:
+            self.log(str(e), 'ProfilerError', level='warn', enabled=True, callerDepth=callerDepth + 2)
+            yield None
+            return
+
+        try:
+            yield sampler
+        finally:
+            sampler.stop()
+            logLabel = 'ProfilerSample -> {}'.format(label)
+            self.log('\n' + '\n'.join(sampler.report(top=top, sortBy=sortBy)), logLabel + ' - Sample Results:', enabled=True, callerDepth=callerDepth + 2)
+            if collapsed:
+                self.log('\n' + '\n'.join(sampler.collapsed()), logLabel + ' - Collapsed Stacks:', enabled=True, callerDepth=callerDepth + 2)
+
+    def span(self, name):
+        """
+        Time a block (or every call of a function) as a nested span:
+            with debug.span('load lines'):
+                with debug.span('dao'):
+                    ...
+            @debug.span('price line')
+            def priceLine(line): ...
+        Spans aggregate count/total/min/max/p95 wall time and CPU time per path and are
+        logged as one tree by reportSpans() on flush() or `with` exit (process exit reports
+        instances that are still alive).
+        Returns a no-op span when debug logging is off; decorated functions check the level on every call.
+        """
+        if not self._shouldLog('debug'):
+            return EtqDebugNullSpan(self, name)
+        return EtqDebugSpan(self, name)
+
+    def _getSpanStack(self):
+        stack = getattr(self._spanLocal, 'stack', None)
+        if stack is None:
+            stack = self._spanLocal.stack = []
+        return stack
+
+    def _recordSpan(self, path, wall, cpu):
+        if not self._exitReportRegistered:
+            # Weakly held by the process-wide hook (see _registerExitReport), so always-on spans do not leak instances
+            self._registerExitReport()
+        with self._spanLock:
+            stats = self._spanStats.get(path)
+            if stats is None:
+                stats = self._spanStats[path] = [0, 0.0, wall, wall, 0.0, []]
+            stats[0] += 1
+            stats[1] += wall
+            stats[2] = min(stats[2], wall)
+            stats[3] = max(stats[3], wall)
+            stats[4] += cpu
+            EtqDebugProfileAccumulator.addSample(stats[5], self.SPAN_MAX_SAMPLES, stats[0], wall)
+
+    def reportSpans(self, reset=True, level='debug'):
+        """Log the aggregated spans as one tree-shaped table."""
+        with self._spanLock:
+            spanStats = self._spanStats
+            if reset:
+                self._spanStats = {}
+        if not spanStats:
+            return
+
+        columns = ['span', 'count', 'total ms', 'avg ms', 'min ms', 'max ms', 'p95 ms', 'cpu ms']
+        rows = []
+        for path in sorted(spanStats.keys()):
+            count, total, low, high, cpu, samples = spanStats[path]
+            rows.append([
+                '  ' * (len(path) - 1) + path[-1], str(count),
+                '{:.1f}'.format(total * 1000), '{:.2f}'.format(total * 1000 / count),
+                '{:.2f}'.format(low * 1000), '{:.2f}'.format(high * 1000),
+                '{:.2f}'.format(self._percentile(sorted(samples), 95) * 1000), '{:.1f}'.format(cpu * 1000)
+            ])
+        columnSizes = [max([len(columns[i])] + [len(row[i]) for row in rows]) for i in range(len(columns))]
+        alignFunc = self._ALIGN_FUNCS['left']
+        lines = [self._formatTableRow(columns, columnSizes, alignFunc), '| ' + ' | '.join('-'*w for w in columnSizes) + ' |']
+        lines += [self._formatTableRow(row, columnSizes, alignFunc) for row in rows]
+        self.log(lines, 'Spans', multiple=True, level=level, multipleShowIndex=False, enabled=True, showCaller=False, maxItems=0)
+
+    @staticmethod
+    def _cpuTime():
+        """CPU seconds used by the current thread (process CPU where thread CPU is unavailable)."""
+        if EtqDebug._threadCpuBean is None:
+            try:
+                from java.lang.management import ManagementFactory
+                bean = ManagementFactory.getThreadMXBean()
+                EtqDebug._threadCpuBean = bean if bean.isCurrentThreadCpuTimeSupported() else False
+            except ImportError:
+                EtqDebug._threadCpuBean = False
+        if EtqDebug._threadCpuBean:
+            return EtqDebug._threadCpuBean.getCurrentThreadCpuTime() / 1e9
+        return time.clock()